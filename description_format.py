@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Author: hq@trekview.org
+# Created: 2020-06-04
+# Copyright: Trek View
+# Licence: GNU AGPLv3
+# -------------------------------------------------------------------------------
+
+'''
+Encoding and decoding of the JSON object written into the ImageDescription of each image.
+
+The full payload (version 1, no "v" key) holds a "photo" and a copy of the "sequence" block.
+The compact payload (version 2) is meant for large sequences that are read back often:
+ * keys are shortened,
+ * None values are left out,
+ * the sequence block is stored by reference ("s": sequence id),
+ * the fields that are the same for every photo of a run (cli_* and software_version)
+   are not stored in the photo but in the sequence block of the report json.
+decode_description() expands both versions to the full payload.
+'''
+
+COMPACT_VERSION = 2
+
+PHOTO_KEYS = {
+    "id": "i",
+    "original_GPSDateTime": "gt",
+    "original_originalDateTime": "ot",
+    "original_filename": "f",
+    "original_altitude": "al",
+    "original_latitude": "la",
+    "original_longitude": "lo",
+    "orignal_gps_direction_ref": "dr",
+    "orignal_gps_speed": "gs",
+    "original_heading": "h",
+    "original_pitch": "pi",
+    "original_roll": "r",
+    "original_camera_make": "mk",
+    "original_camera_model": "md",
+    "original_camera_source": "cs",
+    "original_projection": "pr",
+    "uploader_photo_from_video": "uv",
+    "uploader_nadir_added": "un",
+    "uploader_blur_added": "ub",
+    "uploader_gps_track_added": "ug",
+    "uploader_gps_modified": "um",
+    "uploader_tags": "ut",
+}
+
+CONNECTION_KEYS = {
+    "distance_mtrs": "d",
+    "elevation_mtrs": "e",
+    "heading_deg": "h",
+    "adj_heading_deg": "a",
+    "pitch_deg": "p",
+    "time_sec": "t",
+    "speed_kmh": "s",
+}
+
+# Photo fields that are the same for every photo of a run
+SHARED_PHOTO_KEYS = [
+    "cli_connection_method",
+    "cli_frame_rate_set",
+    "cli_altitude_min_set",
+    "cli_distance_min_set",
+    "software_version",
+]
+
+# Order of the keys in the full photo object
+FULL_PHOTO_KEYS = [
+    "id",
+    "original_GPSDateTime",
+    "original_originalDateTime",
+    "cli_connection_method",
+    "cli_frame_rate_set",
+    "cli_altitude_min_set",
+    "cli_distance_min_set",
+    "original_filename",
+    "original_altitude",
+    "original_latitude",
+    "original_longitude",
+    "orignal_gps_direction_ref",
+    "orignal_gps_speed",
+    "original_heading",
+    "original_pitch",
+    "original_roll",
+    "original_camera_make",
+    "original_camera_model",
+    "original_camera_source",
+    "original_projection",
+    "software_version",
+    "uploader_photo_from_video",
+    "uploader_nadir_added",
+    "uploader_blur_added",
+    "uploader_gps_track_added",
+    "uploader_gps_modified",
+    "uploader_tags",
+]
+
+
+def shared_fields(description):
+    '''
+    Return the fields of a full payload's photo that the compact payload keeps in the sequence block.
+    '''
+    return {key: description['photo'].get(key) for key in SHARED_PHOTO_KEYS}
+
+
+def encode_compact(description):
+    '''
+    Encode a full payload as a compact (version 2) payload.
+    '''
+    photo = description['photo']
+    compact = {
+        "v": COMPACT_VERSION,
+        "s": description['sequence']['id'],
+    }
+    for key, short_key in PHOTO_KEYS.items():
+        if photo.get(key) is not None:
+            compact[short_key] = photo[key]
+    compact["c"] = {
+        connection_uuid: {CONNECTION_KEYS[key]: value for key, value in connection.items() if value is not None}
+        for connection_uuid, connection in photo.get('connections', {}).items()
+    }
+    return compact
+
+
+def decode_description(payload, sequences=None):
+    '''
+    Expand a payload of any version to the full payload.
+    For compact payloads, `sequences` maps sequence ids to the sequence block of their report json
+    (which holds the shared photo fields). Without it, the sequence block only holds its id
+    and the shared photo fields are None.
+    '''
+    if payload.get("v", 1) == 1:
+        return payload
+    if payload["v"] != COMPACT_VERSION:
+        raise ValueError('Unknown ImageDescription payload version {0}'.format(payload["v"]))
+
+    sequence = dict((sequences or {}).get(payload["s"], {"id": payload["s"]}))
+    photo_fields = {key: payload.get(short_key) for key, short_key in PHOTO_KEYS.items()}
+    photo_fields.update({key: sequence.pop(key, None) for key in SHARED_PHOTO_KEYS})
+
+    photo = {key: photo_fields[key] for key in FULL_PHOTO_KEYS}
+    short_connection_keys = {short_key: key for key, short_key in CONNECTION_KEYS.items()}
+    photo["connections"] = {
+        connection_uuid: {short_connection_keys[key]: value for key, value in connection.items()}
+        for connection_uuid, connection in payload.get("c", {}).items()
+    }
+    return {"photo": photo, "sequence": sequence}
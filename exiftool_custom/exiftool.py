@@ -56,6 +56,7 @@ import json
 import warnings
 import logging
 import codecs
+import time
 
 try:        # Py3k compatibility
 	basestring
@@ -143,6 +144,116 @@ def format_error (result):
 		else:
 			return 'exiftool finished with error: "%s"' % strip_nl(result) 
 
+class ExifToolError(Exception):
+	"""Raised by :py:class:`SupervisedExifTool` when a command can not
+	be completed, after the process has been restarted."""
+
+
+class ExifToolTimeout(ExifToolError):
+	"""A command did not finish within the timeout."""
+
+
+class ExifToolDied(ExifToolError):
+	"""The ``exiftool`` process exited while running a command."""
+
+
+def errors_by_file(stderr, filenames):
+	"""Split the ``stderr`` text of a command into the messages about
+	each of ``filenames``.  ``exiftool`` ends its warnings and errors with
+	the name of the file they are about; messages naming no file are
+	attributed to every file of the command.  Files without messages are
+	left out of the returned dictionary.
+	"""
+	errors = {}
+	unattributed = []
+	for line in stderr.splitlines():
+		line = line.strip()
+		if not line:
+			continue
+		matches = [filename for filename in filenames
+				   if line.endswith(filename) or line.endswith(filename.replace(os.sep, "/"))]
+		for filename in matches:
+			errors.setdefault(filename, []).append(line)
+		if not matches:
+			unattributed.append(line)
+	if unattributed:
+		for filename in filenames:
+			errors.setdefault(filename, []).extend(unattributed)
+	return dict((filename, "\n".join(lines)) for filename, lines in errors.items())
+
+
+class BatchController(object):
+	"""Choose how many files to pass to ``exiftool`` per ``-execute``.
+	The right batch size depends on the files and the storage they are
+	on, so it is measured instead of configured: after every batch, call
+	:py:meth:`record()` with the number of files, the seconds it took and
+	the size of the output.  The controller keeps a moving average of the
+	latency and output size per file and sizes the next batch to take
+	about ``target_latency`` seconds without producing more than
+	``max_output_bytes`` of output.  A batch never grows or shrinks by
+	more than a factor two at a time, and stays between ``min_size`` and
+	``max_size`` files.
+	:py:meth:`batches()` additionally keeps the encoded file names of a
+	batch under ``max_arg_bytes``, so a command never exceeds the
+	argument length ``exiftool`` (or the platform) will accept.
+	"""
+
+	def __init__(self, target_latency=1.0, max_output_bytes=64 * 1024 * 1024,
+				 min_size=1, max_size=1000, initial_size=8, max_arg_bytes=128 * 1024,
+				 smoothing=0.5):
+		self.target_latency = target_latency
+		self.max_output_bytes = max_output_bytes
+		self.min_size = min_size
+		self.max_size = max_size
+		self.max_arg_bytes = max_arg_bytes
+		self.smoothing = smoothing
+		self.size = max(min_size, min(initial_size, max_size))
+		self.latency_per_file = None
+		self.output_per_file = None
+
+	def batches(self, filenames):
+		"""Split ``filenames`` into batches of the current size.
+		This is a generator, so the size follows the measurements
+		recorded between batches.
+		"""
+		filenames = list(filenames)
+		position = 0
+		while position < len(filenames):
+			batch = []
+			arg_bytes = 0
+			while position < len(filenames) and len(batch) < self.size:
+				length = len(fsencode(filenames[position])) + 1
+				if batch and arg_bytes + length > self.max_arg_bytes:
+					break
+				batch.append(filenames[position])
+				arg_bytes += length
+				position += 1
+			yield batch
+
+	def record(self, count, latency, output_bytes):
+		"""Update the estimates with a finished batch of ``count`` files
+		and compute the size of the next batch.
+		"""
+		if count <= 0:
+			return
+		latency_per_file = latency / count
+		output_per_file = output_bytes / count
+		if self.latency_per_file is None:
+			self.latency_per_file = latency_per_file
+			self.output_per_file = output_per_file
+		else:
+			self.latency_per_file += self.smoothing * (latency_per_file - self.latency_per_file)
+			self.output_per_file += self.smoothing * (output_per_file - self.output_per_file)
+
+		ideal = self.max_size
+		if self.latency_per_file > 0:
+			ideal = min(ideal, self.target_latency / self.latency_per_file)
+		if self.output_per_file > 0:
+			ideal = min(ideal, self.max_output_bytes / self.output_per_file)
+		ideal = max(self.size / 2.0, min(ideal, self.size * 2.0))
+		self.size = int(max(self.min_size, min(ideal, self.max_size)))
+
+
 class ExifTool(object):
 	"""Run the `exiftool` command-line tool and communicate to it.
 	The argument ``print_conversion`` determines whether exiftool should
@@ -179,6 +290,9 @@ class ExifTool(object):
 	   associated with a running subprocess.
 	"""
 
+	# Whether stderr of the subprocess is piped (and must be read) or discarded
+	capture_stderr = False
+
 	def __init__(self, executable_=None, added_args=None, win_shell=True, print_conversion=False):
 		
 		self.win_shell = win_shell
@@ -189,6 +303,8 @@ class ExifTool(object):
 		else:
 			self.executable = executable_
 		self.running = False
+		self.last_output_size = 0
+		self.last_stderr = ""
 
 		if added_args is None:
 			self.added_args = []
@@ -229,7 +345,8 @@ class ExifTool(object):
 			self._process = subprocess.Popen(
 				proc_args,
 				stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-				stderr=devnull, startupinfo=startup_info)
+				stderr=subprocess.PIPE if self.capture_stderr else devnull,
+				startupinfo=startup_info)
 		self.running = True
 
 	def terminate(self):
@@ -290,6 +407,7 @@ class ExifTool(object):
 				for i in inputready:
 					if i == fd:
 						output += os.read(fd, block_size)
+		self.last_output_size = len(output)
 		return output.strip()[:-len(sentinel)]
 
 	def execute_json(self, *params):
@@ -329,6 +447,50 @@ class ExifTool(object):
 		"""
 		return self.execute_json(*filenames)
 
+	def get_metadata_batches(self, filenames, controller=None, params=()):
+		"""Yield the meta-data of the given files one batch at a time.
+		Batches are sized by ``controller`` (a :py:class:`BatchController`,
+		a default one is used if not given), which is updated with the
+		latency and output size of every batch.  Each item is a tuple of
+		the file names in the batch, the list returned by
+		:py:meth:`execute_json()` for them and the seconds the batch took.
+		Files ``exiftool`` could not read are missing from that list.
+		The last item maps file names to the errors reported about
+		them: with a :py:class:`SupervisedExifTool`, a batch that fails
+		is retried one file at a time, and files that still fail are
+		left out of the metadata with the reason as their error.
+		``params`` are passed before the file names of every batch, e.g.
+		``("-if", condition)`` to leave out the files failing a condition
+		without an error.
+		"""
+		if controller is None:
+			controller = BatchController()
+		for batch in controller.batches(filenames):
+			started = time.monotonic()
+			errors = {}
+			try:
+				metadata = self._get_metadata_or_empty(batch, params)
+				errors = errors_by_file(self.last_stderr, batch)
+			except ExifToolError as e:
+				metadata = []
+				for filename in batch:
+					try:
+						metadata.extend(self._get_metadata_or_empty([filename], params))
+						if self.last_stderr:
+							errors[filename] = self.last_stderr.strip()
+					except ExifToolError as file_error:
+						errors[filename] = "%s: %s" % (type(file_error).__name__, file_error)
+			latency = time.monotonic() - started
+			controller.record(len(batch), latency, self.last_output_size)
+			yield batch, metadata, latency, errors
+
+	def _get_metadata_or_empty(self, filenames, params=()):
+		try:
+			return self.execute_json(*(tuple(params) + tuple(filenames)))
+		except ValueError:
+			# no output at all: none of the files could be read
+			return []
+
 	def get_metadata(self, filename):
 		"""Return meta-data for a single file.
 		The returned dictionary has the format described in the
@@ -472,4 +634,118 @@ class ExifTool(object):
 		Only difference is that it takes as last argument only one file name
 		as a string. 
 		"""
-		return self.set_keywords_batch(mode, keywords, [filename])
\ No newline at end of file
+		return self.set_keywords_batch(mode, keywords, [filename])
+
+
+class SupervisedExifTool(ExifTool):
+	"""An :py:class:`ExifTool` that does not let a single bad file stall
+	a whole batch.
+	- Every command must finish within ``timeout`` seconds.
+	- A process that exits while running a command is detected.
+	- In either case, the process is killed and started again with the
+	  same ``-common_args``, and the command is retried up to
+	  ``retries`` times before :py:class:`ExifToolTimeout` or
+	  :py:class:`ExifToolDied` is raised.
+	- stderr of every command is captured in :py:attr:`last_stderr`,
+	  see :py:func:`errors_by_file()` to split it per file.
+	Timeouts and stderr capture rely on ``select()``, so on Windows
+	only a process that died is detected.
+	"""
+
+	capture_stderr = sys.platform != 'win32'
+
+	def __init__(self, executable_=None, added_args=None, win_shell=True, print_conversion=False,
+				 timeout=60, retries=1):
+		super(SupervisedExifTool, self).__init__(executable_, added_args, win_shell, print_conversion)
+		self.timeout = timeout
+		self.retries = retries
+
+	def terminate(self):
+		"""Terminate the ``exiftool`` process, also if it already died."""
+		if not self.running:
+			return
+		if self._process.poll() is None:
+			try:
+				super(SupervisedExifTool, self).terminate()
+				return
+			except (OSError, ValueError):
+				pass
+		self._kill()
+
+	def _kill(self):
+		try:
+			self._process.kill()
+		except OSError:
+			pass
+		self._process.wait()
+		for pipe in (self._process.stdin, self._process.stdout, self._process.stderr):
+			if pipe is not None:
+				pipe.close()
+		del self._process
+		self.running = False
+
+	def restart(self):
+		"""Kill the ``exiftool`` process and start a new one."""
+		if self.running:
+			self._kill()
+		self.start()
+
+	def execute(self, *params):
+		"""Execute the given batch of parameters like
+		:py:meth:`ExifTool.execute()`, restarting the process and
+		retrying if it hangs or dies.
+		"""
+		attempt = 0
+		while True:
+			try:
+				return self._execute_once(params)
+			except ExifToolError:
+				self.restart()
+				if attempt >= self.retries:
+					raise
+				attempt += 1
+
+	def _execute_once(self, params):
+		if not self.running:
+			raise ValueError("ExifTool instance not running.")
+		if self._process.poll() is not None:
+			raise ExifToolDied("exiftool exited with code %s" % self._process.returncode)
+		if not self.capture_stderr:
+			self.last_stderr = ""
+			try:
+				output = super(SupervisedExifTool, self).execute(*params)
+			except (OSError, ValueError) as e:
+				raise ExifToolDied(str(e))
+			if self._process.poll() is not None:
+				raise ExifToolDied("exiftool exited with code %s" % self._process.returncode)
+			return output
+
+		# -echo4 writes the sentinel to stderr once the command is done,
+		# so stderr can be read up to the end of this command as well
+		cmd_text = b"\n".join(params + (b"-echo4", sentinel, b"-execute\n"))
+		try:
+			self._process.stdin.write(cmd_text)
+			self._process.stdin.flush()
+		except OSError as e:
+			raise ExifToolDied(str(e))
+
+		deadline = None if not self.timeout else time.monotonic() + self.timeout
+		out_fd = self._process.stdout.fileno()
+		err_fd = self._process.stderr.fileno()
+		output = {out_fd: b"", err_fd: b""}
+		pending = [out_fd, err_fd]
+		while pending:
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				raise ExifToolTimeout("no response from exiftool within %s seconds" % self.timeout)
+			inputready, outputready, exceptready = select.select(pending, [], [], remaining)
+			for fd in inputready:
+				chunk = os.read(fd, block_size)
+				if not chunk:
+					raise ExifToolDied("exiftool exited with code %s" % self._process.wait())
+				output[fd] += chunk
+				if output[fd][-32:].strip().endswith(sentinel):
+					pending.remove(fd)
+		self.last_output_size = len(output[out_fd])
+		self.last_stderr = output[err_fd].strip()[:-len(sentinel)].decode("utf-8", "replace")
+		return output[out_fd].strip()[:-len(sentinel)]
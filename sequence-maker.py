@@ -13,13 +13,73 @@ from pathlib import Path
 import datetime
 import json
 import sys
+import tempfile
 import argparse
 import ntpath
+import re
 import time
 import uuid
-
+import concurrent.futures
+import contextlib
+import collections
+import hashlib
+import heapq
+import itertools
+import threading
+import xml.etree.ElementTree
+import xml.sax.saxutils
+
+import numpy as np
 import pandas as pd
 from exiftool_custom import exiftool
+from description_format import decode_description, encode_compact, shared_fields
+from sequence_index import write_index
+
+# Name of the write journal kept in the output directory while images are written
+JOURNAL_FILENAME = 'sequence-maker-journal.jsonl'
+
+# Photo fields left out when comparing a planned ImageDescription with the existing one:
+# they change with the location of the folder or the software version, not with the connections
+VOLATILE_PHOTO_FIELDS = ['original_filename', 'original_camera_source', 'software_version']
+
+# Images Exiftool failed on are listed with their errors in this file in the output directory
+QUARANTINE_FILENAME = 'quarantine.json'
+
+# Images Exiftool left out because they lack the required tags are listed in this file in the output directory
+PREFLIGHT_FILENAME = 'preflight.json'
+
+# XMP sidecar holding a JSON description as dc:description, the XMP counterpart of EXIF:ImageDescription
+XMP_SIDECAR_TEMPLATE = '''<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">
+   <dc:description>
+    <rdf:Alt>
+     <rdf:li xml:lang="x-default">{0}</rdf:li>
+    </rdf:Alt>
+   </dc:description>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+'''
+
+# Version of the partial manifests written in shard mode
+SHARD_MANIFEST_VERSION = 1
+
+# Columns of the computed sequence table exported with --export-table
+TABLE_COLUMNS = ['UUID', 'IMAGE_NAME', 'CAMERA', 'GPS_DATETIME', 'LATITUDE', 'LONGITUDE', 'ALTITUDE',
+                 'DELTA_TIME', 'DISTANCE', 'DELTA_ALT', 'AZIMUTH', 'PITCH',
+                 'DELTA_TIME_TO_PREV', 'DISTANCE_TO_PREV', 'DELTA_ALT_TO_PREV', 'AZIMUTH_TO_PREV', 'PITCH_TO_PREV',
+                 'UUID_NEXT', 'UUID_PREV', 'IMAGE_NAME_NEXT', 'IMAGE_NAME_PREV']
+
+# Rings of grid cells searched around an image for its nearest image in spatial_order(), before scanning all images,
+# and the number of images above which the images of a cell are compared with numpy
+SPATIAL_SEARCH_RINGS = 8
+SPATIAL_CELL_SCAN = 32
+
+# Namespace of the deterministic photo and sequence UUIDs
+UUID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/trek-view/sequence-maker')
 
 
 def calculate_initial_compass_bearing(pointA, pointB):
@@ -119,29 +179,368 @@ def parse_metadata(dfrow, keys, discard):
     return values
 
 
-def generic_connection(df_images, connection_type, minimum):
+def read_track_logs(paths):
+    '''
+    Read GPX and CSV track logs into one table of track points (TIME in UTC epoch seconds, LATITUDE,
+    LONGITUDE, ALTITUDE) sorted by time.
+    CSV files need a time column (time, timestamp or datetime), latitude (lat or latitude),
+    longitude (lon, lng or longitude) and optionally altitude (ele, elevation, alt or altitude).
+    '''
+    tracks = []
+    for path in paths:
+        if path.lower().endswith('.gpx'):
+            points = []
+            for _, element in xml.etree.ElementTree.iterparse(path):
+                if element.tag.split('}')[-1] != 'trkpt':
+                    continue
+                point = {'TIME': None, 'LATITUDE': float(element.get('lat')),
+                         'LONGITUDE': float(element.get('lon')), 'ALTITUDE': float('NaN')}
+                for child in element:
+                    tag = child.tag.split('}')[-1]
+                    if tag == 'time':
+                        point['TIME'] = child.text
+                    elif tag == 'ele':
+                        point['ALTITUDE'] = float(child.text)
+                points.append(point)
+                element.clear()
+            track = pd.DataFrame(points, columns=['TIME', 'LATITUDE', 'LONGITUDE', 'ALTITUDE'])
+        else:
+            track = pd.read_csv(path)
+            columns = {}
+            for column in track.columns:
+                name = column.strip().lower()
+                if name in ['time', 'timestamp', 'datetime']:
+                    columns[column] = 'TIME'
+                elif name in ['lat', 'latitude']:
+                    columns[column] = 'LATITUDE'
+                elif name in ['lon', 'lng', 'longitude']:
+                    columns[column] = 'LONGITUDE'
+                elif name in ['ele', 'elevation', 'alt', 'altitude']:
+                    columns[column] = 'ALTITUDE'
+            track = track.rename(columns=columns)
+            missing = [column for column in ['TIME', 'LATITUDE', 'LONGITUDE'] if column not in track.columns]
+            if missing:
+                raise ValueError('Track log {0} has no {1} column'.format(path, ', '.join(missing).lower()))
+            if 'ALTITUDE' not in track.columns:
+                track['ALTITUDE'] = float('NaN')
+            track = track[['TIME', 'LATITUDE', 'LONGITUDE', 'ALTITUDE']]
+        tracks.append(track)
+
+    track = pd.concat(tracks, ignore_index=True)
+    track['TIME'] = (pd.to_datetime(track['TIME'], utc=True, errors='coerce')
+                     - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+    track = track.dropna(subset=['TIME', 'LATITUDE', 'LONGITUDE'])
+    return track.sort_values('TIME').drop_duplicates('TIME').reset_index(drop=True)
+
+
+def interpolate_track(track, times, max_gap):
     '''
-    A function to calculate the difference and links of a certain difference type.
-    Differences must be linear.
+    Return the latitudes, longitudes and altitudes at `times` (UTC epoch seconds), linearly interpolated
+    between the two track points around each time in one searchsorted pass.
+    Times outside the track, or between track points more than `max_gap` seconds apart, get NaN.
+    Track points without an altitude interpolate to a NaN altitude.
     '''
-    df_images['CUM_{0}'.format(connection_type)] = float(0)
+    track_times = track['TIME'].values
+    times = np.asarray(times, dtype=float)
+    if len(track_times) < 2:
+        return tuple(np.full(len(times), np.nan) for _ in range(3))
+
+    after = np.clip(np.searchsorted(track_times, times, side='left'), 1, len(track_times) - 1)
+    before = after - 1
+    gap = track_times[after] - track_times[before]
+    fraction = (times - track_times[before]) / gap
+    on_point = (times == track_times[before]) | (times == track_times[after])
+    covered = (times >= track_times[0]) & (times <= track_times[-1]) & ((gap <= max_gap) | on_point)
+
+    values = []
+    for column in ['LATITUDE', 'LONGITUDE', 'ALTITUDE']:
+        points = track[column].values.astype(float)
+        value = points[before] + (points[after] - points[before]) * fraction
+        values.append(np.where(covered, value, np.nan))
+    return tuple(values)
+
 
-    for index, row in df_images.iterrows():
-        if index == 0:
-            df_images.iat[index, df_images.columns.get_loc('CUM_{0}'.format(connection_type))] = 0
+def haversine_array(lon1, lat1, lon2, lat2):
+    '''
+    Vectorised haversine() over numpy arrays, in meters.
+    '''
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * 6371 * 1000
+
+
+def project_coordinates(latitudes, longitudes):
+    '''
+    Project coordinates to meters on a plane tangent to their centre (equirectangular),
+    which is accurate enough to compare distances between the images of a sequence.
+    '''
+    latitude_0 = np.radians(np.mean(latitudes))
+    x = np.radians(longitudes) * np.cos(latitude_0) * 6371 * 1000
+    y = np.radians(latitudes) * 6371 * 1000
+    return x, y
+
+
+def spatial_order(latitudes, longitudes, two_opt_window=0):
+    '''
+    Order images into a path by their position only, with double-ended greedy nearest neighbour chaining:
+    the path starts at one image and grows at whichever of its two ends is closest to an image not visited yet,
+    so it does not matter whether the path starts at an end or somewhere halfway.
+    Nearest images are found with a sparse grid index whose cells are about the typical distance between
+    neighbouring images (see typical_spacing()), searched in growing rings around the cell of the end.
+    A search that finds nothing within SPATIAL_SEARCH_RINGS rings (a gap in the route or an outlier) scans
+    all images left with numpy instead, and crowded cells are scanned with numpy as well. Images at the same
+    position (e.g. a parked camera) are chained as one image, so the chaining stays about O(n log n)
+    instead of needing a distance matrix. An end whose nearest image was taken by the other end is only
+    searched again once it could be the closer end, and no further than the distance of the other end,
+    so a dead end far from the rest of the images does not search the whole grid at every step.
+    If two_opt_window > 0, the path is refined with 2-opt moves between images at most that many
+    positions apart, which removes most crossings the greedy chaining leaves behind.
+    '''
+    x, y = project_coordinates(np.asarray(latitudes, dtype='float64'), np.asarray(longitudes, dtype='float64'))
+    if len(x) < 3:
+        return np.arange(len(x))
+
+    # Images at the same position follow each other in filename order
+    positions, position_of_image = np.unique(np.column_stack([x, y]), axis=0, return_inverse=True)
+    position_order = greedy_chain(positions[:, 0], positions[:, 1])
+    position_rank = np.empty(len(positions), dtype=int)
+    position_rank[position_order] = np.arange(len(positions))
+    order = np.lexsort((np.arange(len(x)), position_rank[position_of_image.ravel()]))
+
+    if two_opt_window > 0:
+        order = two_opt(order, x, y, two_opt_window)
+    return order
+
+
+def greedy_chain(x, y):
+    '''
+    Return the order of the double-ended greedy nearest neighbour chaining of spatial_order() for images at
+    distinct (projected) positions.
+    '''
+    n = len(x)
+    if n < 3:
+        return np.arange(n)
+
+    cell_size = typical_spacing(x, y)
+    cell_x = np.floor((x - x.min()) / cell_size).astype(int)
+    cell_y = np.floor((y - y.min()) / cell_size).astype(int)
+    grid_size = (cell_x.max() + 1, cell_y.max() + 1)
+    grid = {}
+    for index in range(n):
+        grid.setdefault((cell_x[index], cell_y[index]), set()).add(index)
+    alive = np.ones(n, dtype=bool)
+
+    def scan(current, candidates):
+        # Nearest of some candidates, with numpy
+        squared = (x[candidates] - x[current]) ** 2 + (y[candidates] - y[current]) ** 2
+        position = int(np.argmin(squared))
+        return int(candidates[position]), float(squared[position])
+
+    def nearest(current, limit=float('inf')):
+        # Return the nearest image and its squared distance, or None and a lower bound of that distance
+        # if no image is closer than limit
+        best, best_squared = None, float('inf')
+        for ring in range(SPATIAL_SEARCH_RINGS + 1):
+            # Images in this ring are at least (ring - 1) cells away
+            bound = ((ring - 1) * cell_size) ** 2 if ring > 0 else 0.0
+            if best is not None and best_squared <= bound:
+                return best, best_squared
+            if bound > limit:
+                return None, bound
+            for cell in ring_cells(cell_x[current], cell_y[current], ring, grid_size):
+                candidates = grid.get(cell)
+                if not candidates:
+                    continue
+                if len(candidates) > SPATIAL_CELL_SCAN:
+                    candidate, squared = scan(current, np.fromiter(candidates, dtype=int, count=len(candidates)))
+                    if squared < best_squared:
+                        best, best_squared = candidate, squared
+                else:
+                    for candidate in candidates:
+                        squared = (x[candidate] - x[current]) ** 2 + (y[candidate] - y[current]) ** 2
+                        if squared < best_squared:
+                            best, best_squared = candidate, squared
+                # Nothing is closer than an image at the same position
+                if best_squared == 0:
+                    return best, best_squared
+        # All images within SPATIAL_SEARCH_RINGS cells were searched
+        bound = (SPATIAL_SEARCH_RINGS * cell_size) ** 2
+        if best is not None and best_squared <= bound:
+            return best, best_squared
+        if bound > limit:
+            return None, bound
+        candidates = np.flatnonzero(alive)
+        if len(candidates) == 0:
+            return None, float('inf')
+        return scan(current, candidates)
+
+    def take(image):
+        grid[(cell_x[image], cell_y[image])].discard(image)
+        alive[image] = False
+
+    start = int(np.argmin(x))
+    take(start)
+    path = collections.deque([start])
+    head = tail = nearest(start)
+    while len(path) < n:
+        # An end holding only a lower bound is searched again when it is the closer end
+        if head[1] <= tail[1]:
+            if head[0] is None:
+                head = nearest(path[0], tail[1])
+                continue
+            image = head[0]
+            path.appendleft(image)
+            moved_head = True
+        else:
+            if tail[0] is None:
+                tail = nearest(path[-1], head[1])
+                continue
+            image = tail[0]
+            path.append(image)
+            moved_head = False
+        take(image)
+        # The end that moved needs a new search, the other end keeps the distance of its taken image as a bound
+        if moved_head:
+            head = (None, 0.0)
+            tail = (None, tail[1]) if tail[0] == image else tail
         else:
-            df_images.iat[index, df_images.columns.get_loc('CUM_{0}'.format(connection_type))] = \
-            df_images['CUM_{0}'.format(connection_type)].loc[index - 1] + df_images[connection_type].loc[index]
+            tail = (None, 0.0)
+            head = (None, head[1]) if head[0] == image else head
 
-            if df_images.iat[index, df_images.columns.get_loc('CUM_{0}'.format(connection_type))] >= minimum:
-                df_images.iat[index, df_images.columns.get_loc('CUM_{0}'.format(connection_type))] = 0
+    return np.array(path)
 
-                # Only keep rows where cumdeltatime = 0 -> difference with previous picture bigger than minimum.
-    # Actual cumulated values are recalculated later
-    df_images = df_images[df_images['CUM_{0}'.format(connection_type)] == 0]
-    df_images.reset_index(inplace=True, drop=True)
 
-    return df_images
+def typical_spacing(x, y, samples=256):
+    '''
+    Return the median distance from an image to its nearest image at another position, estimated on a sample of
+    the images, or 1 (metre) if all images are at the same position. Unlike the area of the bounding box,
+    it is not changed by an outlier, images at the same position or images on a straight line.
+    '''
+    sample = np.unique(np.linspace(0, len(x) - 1, min(len(x), samples)).astype(int))
+    nearest_distances = []
+    for chunk in np.array_split(sample, max(1, len(sample) // 32)):
+        squared = (x[None, :] - x[chunk, None]) ** 2 + (y[None, :] - y[chunk, None]) ** 2
+        squared[squared == 0] = np.inf
+        nearest_distances.append(np.sqrt(squared.min(axis=1)))
+    nearest_distances = np.concatenate(nearest_distances)
+    nearest_distances = nearest_distances[np.isfinite(nearest_distances)]
+    if len(nearest_distances) == 0:
+        return 1.0
+    return max(float(np.median(nearest_distances)), 1e-3)
+
+
+def ring_cells(center_x, center_y, ring, grid_size):
+    '''
+    Return the cells of a grid of grid_size cells at exactly `ring` cells (Chebyshev distance) from a cell.
+    '''
+    if ring == 0:
+        return [(center_x, center_y)]
+    size_x, size_y = grid_size
+    cells = []
+    for cell_y in (center_y - ring, center_y + ring):
+        if 0 <= cell_y < size_y:
+            cells.extend((cell_x, cell_y) for cell_x in range(max(center_x - ring, 0), min(center_x + ring, size_x - 1) + 1))
+    for cell_x in (center_x - ring, center_x + ring):
+        if 0 <= cell_x < size_x:
+            cells.extend((cell_x, cell_y) for cell_y in range(max(center_y - ring + 1, 0), min(center_y + ring - 1, size_y - 1) + 1))
+    return cells
+
+
+def two_opt(order, x, y, window, max_passes=10):
+    '''
+    Improve an open path with 2-opt moves: reversing the part of the path between positions i + 1 and j
+    when that shortens it, for j at most `window` positions after i. After the first pass, only positions
+    near a reversed part are checked again, until no move shortens the path (or max_passes is reached).
+    '''
+    order = order.copy()
+    path_x = x[order]
+    path_y = y[order]
+    n = len(order)
+
+    # i = -1 allows reversing the start of the path, j = n - 1 reversing its end
+    positions = range(-1, n - 2)
+    for _ in range(max_passes):
+        changed = set()
+        for i in positions:
+            j = np.arange(i + 2, min(i + 1 + window, n - 1) + 1)
+            next_x = np.append(path_x[j[:-1] + 1], path_x[j[-1] + 1] if j[-1] < n - 1 else np.nan)
+            next_y = np.append(path_y[j[:-1] + 1], path_y[j[-1] + 1] if j[-1] < n - 1 else np.nan)
+            # Edges (i, i + 1) and (j, j + 1) are replaced by (i, j) and (i + 1, j + 1); missing edges count 0
+            removed = np.nan_to_num(np.hypot(path_x[j] - next_x, path_y[j] - next_y))
+            added = np.nan_to_num(np.hypot(path_x[i + 1] - next_x, path_y[i + 1] - next_y))
+            if i >= 0:
+                removed += math.hypot(path_x[i] - path_x[i + 1], path_y[i] - path_y[i + 1])
+                added += np.hypot(path_x[i] - path_x[j], path_y[i] - path_y[j])
+            gains = removed - added
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                reverse = slice(i + 1, j[best] + 1)
+                order[reverse] = order[reverse][::-1].copy()
+                path_x[reverse] = path_x[reverse][::-1].copy()
+                path_y[reverse] = path_y[reverse][::-1].copy()
+                changed.update(range(max(i - window, -1), min(j[best] + 1, n - 2)))
+        if not changed:
+            break
+        positions = sorted(changed)
+    return order
+
+
+def fused_filter(df_images, min_time_interval, min_distance_interval, min_altitude_interval, carry=None):
+    '''
+    Select the images to keep for the spacing thresholds in a single sweep over the sorted images,
+    and return their positions.
+
+    The first image is always kept. Every other image is kept when, measured from the last kept image,
+    ALL enabled thresholds (> 0) are reached:
+     * time: the time passed along the images in between (sum of absolute time steps) >= min_time_interval,
+     * distance: the distance travelled along the images in between (sum of haversine steps) >= min_distance_interval,
+     * altitude: the absolute altitude difference with the last kept image >= min_altitude_interval.
+    Time and distance only grow along the sequence, so the first image reaching both is found
+    with a binary search; from there the altitude condition is checked image by image.
+    As every search starts after the last kept image, the sweep is O(n log n) at worst.
+
+    To filter a sequence window by window, pass the same `carry` dict for every window, starting with an empty one.
+    It holds the time and distance travelled since the last kept image and its altitude at the end of a window,
+    and the next window must start with the last image of the previous one (which is not kept again).
+    '''
+    n = len(df_images)
+    times = df_images['GPS_DATETIME'].values.astype('datetime64[ms]').astype('float64') / 1000
+    latitudes = df_images['LATITUDE'].values.astype('float64')
+    longitudes = df_images['LONGITUDE'].values.astype('float64')
+    altitudes = df_images['ALTITUDE'].values.astype('float64')
+
+    cum_time = np.concatenate([[0.0], np.cumsum(np.abs(np.diff(times)))])
+    cum_distance = np.concatenate([[0.0], np.cumsum(
+        haversine_array(longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:]))])
+
+    if carry:
+        # The first image is the last image of the previous window, measure from its last kept image
+        kept = []
+        last_time, last_distance, last_altitude = -carry['time'], -carry['distance'], carry['altitude']
+    else:
+        kept = [0]
+        last_time, last_distance, last_altitude = 0.0, 0.0, altitudes[0]
+    last = 0
+    while True:
+        candidate = last + 1
+        if min_time_interval > 0:
+            candidate = max(candidate, int(np.searchsorted(cum_time, last_time + min_time_interval, 'left')))
+        if min_distance_interval > 0:
+            candidate = max(candidate, int(np.searchsorted(cum_distance, last_distance + min_distance_interval,
+                                                           'left')))
+        if min_altitude_interval > 0:
+            while candidate < n and abs(altitudes[candidate] - last_altitude) < min_altitude_interval:
+                candidate += 1
+        if candidate >= n:
+            break
+        kept.append(candidate)
+        last = candidate
+        last_time, last_distance, last_altitude = cum_time[last], cum_distance[last], altitudes[last]
+
+    if carry is not None:
+        carry.update({'time': cum_time[-1] - last_time, 'distance': cum_distance[-1] - last_distance,
+                      'altitude': last_altitude})
+    return np.array(kept, dtype=int)
 
 
 def calculate_to_next(df_images, connection_type):
@@ -178,11 +577,129 @@ def calculate_to_next(df_images, connection_type):
     return df_images
 
 
-def clean_up_new_files(OUTPUT_PHOTO_DIRECTORY, list_of_files):
+def link_images(df_images):
+    '''
+    Calculate the time, distance, altitude, heading and pitch of every image (at least two, in sequence order)
+    to its NEXT and PREVIOUS image. The last image gets the values of the one before it,
+    the values of the first image to its PREVIOUS image are 0.
+    '''
+    # Calculate all differences to their NEXT image
+    for conn_type in ['DELTA_TIME', 'DISTANCE', 'DELTA_ALT']:
+        df_images = calculate_to_next(df_images, conn_type)
+
+    # Calculate Azimuth (heading) and Pitch
+    df_images['AZIMUTH'] = df_images.apply(lambda x: calculate_initial_compass_bearing((x['LATITUDE'], x['LONGITUDE']),
+                                                                                       (x['LATITUDE_NEXT'],
+                                                                                        x['LONGITUDE_NEXT'])), axis=1)
+    df_images.iat[-1, df_images.columns.get_loc('AZIMUTH')] = df_images['AZIMUTH'].iloc[-2]
+    df_images['PITCH'] = (df_images['ALTITUDE_NEXT'] - df_images['ALTITUDE']) / df_images['DISTANCE']
+
+    # Add additional required data for output json.
+    # All related to PREVIOUS image
+    df_images['DISTANCE_TO_PREV'] = -1 * df_images['DISTANCE'].shift(1, fill_value=0)
+    df_images['DELTA_TIME_TO_PREV'] = -1 * df_images['DELTA_TIME'].shift(1)
+    df_images['DELTA_ALT_TO_PREV'] = -1 * df_images['DELTA_ALT'].shift(1)
+    df_images['PITCH_TO_PREV'] = -1 * df_images['PITCH'].shift(1)
+    df_images['AZIMUTH_TO_PREV'] = (df_images['AZIMUTH'].shift(1) + 180) % 360
+
+    df_images.iat[0, df_images.columns.get_loc('DELTA_ALT_TO_PREV')] = 0
+    df_images.iat[0, df_images.columns.get_loc('DISTANCE_TO_PREV')] = 0
+    df_images.iat[0, df_images.columns.get_loc('DELTA_TIME_TO_PREV')] = 0
+    df_images.iat[0, df_images.columns.get_loc('AZIMUTH_TO_PREV')] = 0
+    df_images.iat[0, df_images.columns.get_loc('PITCH_TO_PREV')] = 0
+
+    # Add names of the NEXT and PREVIOUS image for quicker reference
+    df_images['IMAGE_NAME_NEXT'] = df_images['IMAGE_NAME'].shift(-1)
+    df_images['IMAGE_NAME_PREV'] = df_images['IMAGE_NAME'].shift(1)
+
+    return df_images
+
+
+def get_output_names(images):
+    '''
+    Return the filename to use in the output directory for the images whose filename is also used by an image
+    of another camera (input folder), e.g. GSAC0001.JPG of every camera of a rig: <camera>_<filename>,
+    the camera being the name of the input folder. Images with a unique filename are left out, they keep it.
+    '''
+    images_by_name = collections.defaultdict(list)
+    for image in images:
+        images_by_name[ntpath.basename(image)].append(image)
+    output_names = {}
+    for image_name, named_images in images_by_name.items():
+        if len(named_images) > 1:
+            for image in named_images:
+                output_names[image] = '{0}_{1}'.format(ntpath.basename(ntpath.dirname(image)), image_name)
+    return output_names
+
+
+def find_output_collisions(images):
+    '''
+    Return the output filenames (see get_output_names()) still used by several images,
+    which happens if input folders with the same name hold images with the same filename.
+    '''
+    output_names = get_output_names(images)
+    counts = collections.Counter(get_output_name(image, output_names) for image in images)
+    return sorted(image_name for image_name, count in counts.items() if count > 1)
+
+
+def get_output_name(image, output_names=None):
+    '''
+    Return the filename of an image in the output directory, see get_output_names().
+    '''
+    return (output_names or {}).get(image, ntpath.basename(image))
+
+
+def get_calculated_file_name(OUTPUT_PHOTO_DIRECTORY, image, output_names=None):
+    '''
+    Return the path in the output directory a processed image is moved to.
+    '''
+    image_name = get_output_name(image, output_names)
+    return os.path.join(os.path.abspath(OUTPUT_PHOTO_DIRECTORY),
+                        '{0}_calculated.{1}'.format(image_name.split('.')[0], image.split('.')[-1]))
+
+
+def get_original_file_name(image):
+    '''
+    Return the filename of an image, without the _calculated suffix if it is an output image.
+    '''
+    image_stem, image_extension = os.path.splitext(ntpath.basename(image))
+    if image_stem.endswith('_calculated'):
+        image_stem = image_stem[:-len('_calculated')]
+    return image_stem + image_extension
+
+
+def get_sidecar_file_name(OUTPUT_PHOTO_DIRECTORY, image, output_names=None):
+    '''
+    Return the path of the XMP sidecar of an image in the output directory.
+    '''
+    return os.path.join(OUTPUT_PHOTO_DIRECTORY,
+                        '{0}.xmp'.format(os.path.splitext(get_output_name(image, output_names))[0]))
+
+
+def move_new_file(OUTPUT_PHOTO_DIRECTORY, image, output_names=None):
+    '''
+    Move the image written by Exiftool to the output directory and restore the original.
+    The `_original` copy Exiftool made tells whether the image still has to be moved: while it exists,
+    the image is the freshly written one and replaces any file of an earlier run in the output directory.
+    Without it, the image was moved already, so an interrupted move can be finished.
+    '''
+    image_head, image_name = ntpath.split(image)
+    original = os.path.join(os.path.abspath(image_head), '{0}_original'.format(image_name))
+    calculated = get_calculated_file_name(OUTPUT_PHOTO_DIRECTORY, image, output_names)
+
+    if os.path.isfile(original):
+        # The image is missing if the process died between both renames
+        if os.path.isfile(image):
+            os.replace(image, calculated)
+        os.rename(original, image)
+
+
+def clean_up_new_files(OUTPUT_PHOTO_DIRECTORY, list_of_files, journal=None, img_uuid_link=None, output_names=None):
     '''
     As Exiftool creates a copy of the original image when processing,
-    the new files are copied to the output directory,
+    the new files are copied to the output directory (named as get_output_names() says),
     original files are renamed to original filename.
+    If a write journal is given, every moved image is recorded in it.
     '''
 
     print('Cleaning up old and new files...')
@@ -192,20 +709,669 @@ def clean_up_new_files(OUTPUT_PHOTO_DIRECTORY, list_of_files):
     for image in list_of_files:
         image_head, image_name = ntpath.split(image)
         try:
-            os.rename(image, os.path.join(os.path.abspath(OUTPUT_PHOTO_DIRECTORY),
-                                          '{0}_calculated.{1}'.format(image_name.split('.')[0], image.split('.')[-1])))
-            os.rename(os.path.join(os.path.abspath(image_head), '{0}_original'.format(image_name)), image)
+            move_new_file(OUTPUT_PHOTO_DIRECTORY, image, output_names)
         except PermissionError:
             print("Image {0} is still in use by Exiftool's process or being moved'. Waiting before moving it...".format(
                 image_name))
             time.sleep(3)
-            os.rename(image, os.path.join(os.path.abspath(OUTPUT_PHOTO_DIRECTORY),
-                                          '{0}_calculated.{1}'.format(image_name.split('.')[0], image.split('.')[-1])))
-            os.rename(os.path.join(os.path.abspath(image_head), '{0}_original'.format(image_name)), image)
+            move_new_file(OUTPUT_PHOTO_DIRECTORY, image, output_names)
+
+        if journal is not None:
+            log_journal(journal, img_uuid_link[image], 'renamed')
 
     print('Output files saved to {0}'.format(os.path.abspath(OUTPUT_PHOTO_DIRECTORY)))
 
 
+def start_journal(journal_path, sequence_uuid, report_json, descriptions, img_id_link, output_names=None):
+    '''
+    Create the write journal of a run. The first line holds everything needed to finish the
+    write phase without reading the images again: the planned ImageDescription of each image,
+    the image it belongs to, its name in the output directory if it differs and the report json.
+    Progress lines are appended after it.
+    '''
+    journal = open(journal_path, 'w')
+    journal.write(json.dumps({
+        'sequence_id': str(sequence_uuid),
+        'report': report_json,
+        'descriptions': descriptions,
+        'files': img_id_link,
+        'output_names': output_names or {}
+    }) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+    return journal
+
+
+def log_journal(journal, image_uuid, status):
+    '''
+    Record that an image reached a status ('written' or 'renamed').
+    Lines are flushed immediately so they survive the process dying.
+    '''
+    journal.write(json.dumps({'id': image_uuid, 'status': status}) + '\n')
+    journal.flush()
+
+
+def read_journal(journal_path):
+    '''
+    Read a write journal and return its header and the last known status of each image.
+    A line cut off by a crash is ignored.
+    '''
+    with open(journal_path, 'r') as journal:
+        header = json.loads(journal.readline())
+        statuses = {}
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            statuses[entry['id']] = entry['status']
+    return header, statuses
+
+
+def open_exiftool(timeout=0, capture_errors=False):
+    '''
+    Return the Exiftool instance to use: supervised (timeouts, restarts and per-file errors) if a timeout is set,
+    or if the errors of every file are needed (without timeout then).
+    '''
+    if timeout or capture_errors:
+        return exiftool.SupervisedExifTool(timeout=timeout)
+    return exiftool.ExifTool()
+
+
+def write_descriptions(descriptions, img_id_link, journal=None, telemetry=None, timeout=0, et=None):
+    '''
+    Write each JSON description into the EXIF::ImageDescription of its image.
+    Return the images that could not be written, with their error. These are quarantined:
+    they are left out of the clean up, and --resume will try them again.
+    An Exiftool process that is already running can be given as `et`.
+    '''
+    quarantined = {}
+    if telemetry is not None:
+        telemetry.start_stage('write', len(descriptions))
+    with (open_exiftool(timeout) if et is None else contextlib.nullcontext(et)) as et:
+        for image_uuid in descriptions.keys():
+            image = img_id_link[image_uuid]
+            started = time.monotonic()
+            try:
+                result = et.execute(bytes('-ImageDescription={0}'.format(json.dumps(descriptions[image_uuid])), 'utf-8'),
+                                    bytes("{0}".format(image), 'utf-8'))
+                if not exiftool.check_ok(result.decode('utf-8', 'replace')):
+                    quarantined[image] = et.last_stderr or exiftool.format_error(result.decode('utf-8', 'replace'))
+            except exiftool.ExifToolError as e:
+                quarantined[image] = '{0}: {1}'.format(type(e).__name__, e)
+
+            if telemetry is not None:
+                telemetry.update(image, time.monotonic() - started)
+            if journal is not None:
+                log_journal(journal, image_uuid, 'quarantined' if image in quarantined else 'written')
+    if telemetry is not None:
+        telemetry.finish_stage()
+    if quarantined:
+        print('{0} images could not be written and are quarantined.'.format(len(quarantined)))
+    return quarantined
+
+
+def write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, stage, errors):
+    '''
+    Add the images that failed in a stage, with their Exiftool errors, to quarantine.json in the output directory.
+    '''
+    if not errors:
+        return
+    report_path = os.path.join(OUTPUT_PHOTO_DIRECTORY, QUARANTINE_FILENAME)
+    report = {}
+    if os.path.isfile(report_path):
+        with open(report_path, 'r') as infile:
+            report = json.load(infile)
+    report.setdefault(stage, {}).update(errors)
+    with open(report_path, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print('Errors of {0} images saved to {1}'.format(len(errors), report_path))
+
+
+def required_tags_condition(keys):
+    '''
+    Build the Exiftool -if condition an image has to pass to hold every required metadata key.
+    '''
+    return ' and '.join('defined ${0}'.format(key) for key in keys)
+
+
+def write_preflight_report(OUTPUT_PHOTO_DIRECTORY, keys, condition, checked, discarded):
+    '''
+    Save the images that failed the required tags condition to preflight.json in the output directory.
+    '''
+    report_path = os.path.join(OUTPUT_PHOTO_DIRECTORY, PREFLIGHT_FILENAME)
+    report = {
+        "required_tags": keys,
+        "condition": condition,
+        "images_checked": checked,
+        "images_discarded": len(discarded),
+        "discarded": sorted(discarded),
+    }
+    with open(report_path, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print('{0} images without the required metadata saved to {1}'.format(len(discarded), report_path))
+    return report_path
+
+
+def write_sidecars(OUTPUT_PHOTO_DIRECTORY, descriptions, img_id_link, output_names=None):
+    '''
+    Write each JSON description into an XMP sidecar (dc:description) named after its image
+    in the output directory. The images themselves are not touched.
+    '''
+    print('Writing XMP sidecars of qualified images...\n')
+    for image_uuid, description in descriptions.items():
+        sidecar = get_sidecar_file_name(OUTPUT_PHOTO_DIRECTORY, img_id_link[image_uuid], output_names)
+        with open(sidecar, 'w', encoding='utf-8') as outfile:
+            outfile.write(XMP_SIDECAR_TEMPLATE.format(xml.sax.saxutils.escape(json.dumps(description))))
+    print('Sidecars saved to {0}'.format(OUTPUT_PHOTO_DIRECTORY))
+
+
+def write_manifest(OUTPUT_PHOTO_DIRECTORY, sequence_uuid, descriptions, img_id_link, output_names=None):
+    '''
+    Write the JSON descriptions of all images into one manifest keyed by filename
+    (<camera>_<filename> for filenames used by several cameras, see get_output_names()).
+    The images themselves are not touched.
+    '''
+    manifest_path = os.path.join(OUTPUT_PHOTO_DIRECTORY, '{0}_manifest.json'.format(sequence_uuid))
+    print('Writing manifest of qualified images...\n')
+    with open(manifest_path, 'w') as outfile:
+        json.dump({get_output_name(img_id_link[image_uuid], output_names): description
+                   for image_uuid, description in descriptions.items()}, outfile)
+    print('Manifest saved to {0}'.format(manifest_path))
+
+
+def write_table(sequence_uuid, df_images, table_formats):
+    '''
+    Export the computed sequence table, one row per image, next to the report json.
+    parquet: compressed columnar file for analytics jobs,
+    arrow: compressed Arrow IPC file,
+    feather: uncompressed Arrow IPC file, which readers can memory-map without copying.
+    pyarrow is checked for when the arguments are read.
+    '''
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    df_table = df_images[TABLE_COLUMNS].copy()
+    df_table.insert(0, 'SEQUENCE_ID', str(sequence_uuid))
+    table = pyarrow.Table.from_pandas(df_table, preserve_index=False)
+
+    for table_format in table_formats:
+        table_path = '{0}.{1}'.format(sequence_uuid, table_format)
+        print('Writing {0} table to {1}'.format(table_format, table_path))
+        if table_format == 'parquet':
+            pyarrow.parquet.write_table(table, table_path)
+        elif table_format == 'arrow':
+            pyarrow.feather.write_feather(table, table_path, compression='zstd')
+        else:
+            pyarrow.feather.write_feather(table, table_path, compression='uncompressed')
+
+
+def write_graph_index(sequence_uuid, df_images):
+    '''
+    Write the binary index of the photos and their neighbours (see sequence_index.py) next to the report json.
+    '''
+    index_path = '{0}.idx'.format(sequence_uuid)
+    print('Writing sequence index to {0}'.format(index_path))
+    write_index(index_path, sequence_uuid, df_images['UUID'], df_images['GPS_DATETIME'])
+
+
+def write_report(sequence_uuid, report_json):
+    print('Writing report json')
+    with open("{}.json".format(sequence_uuid), "w") as outfile:
+        json.dump(report_json, outfile)
+
+
+def resume_sequence(OUTPUT_PHOTO_DIRECTORY, journal_path, telemetry=None, timeout=0):
+    '''
+    Finish the write phase of an interrupted run from its write journal.
+    Only images whose description was not written yet are passed to Exiftool,
+    and only images not moved yet are moved to the output directory.
+    The state on disk is checked as well, as the process can die between
+    an Exiftool write or a rename and its journal line.
+    '''
+    if not os.path.isfile(journal_path):
+        print('No unfinished run found in {0}. Nothing to resume.'.format(os.path.abspath(OUTPUT_PHOTO_DIRECTORY)))
+        input('Press any key to quit')
+        quit()
+
+    header, statuses = read_journal(journal_path)
+    descriptions = header['descriptions']
+    img_id_link = header['files']
+    output_names = header.get('output_names', {})
+
+    to_write = {}
+    to_move = []
+    for image_uuid, image in img_id_link.items():
+        status = statuses.get(image_uuid)
+        if status == 'renamed':
+            continue
+        original = '{0}_original'.format(image)
+        # A file in the output directory can be left from an earlier run, only the journal
+        # and the _original copy of Exiftool tell whether this run wrote the image
+        if status != 'written' and not os.path.isfile(original):
+            to_write[image_uuid] = descriptions[image_uuid]
+        if os.path.isfile(original) or status == 'written' or image_uuid in to_write:
+            to_move.append(image)
+
+    print('Resuming sequence {0}: {1} of {2} image(s) still to write, {3} still to move.\n'.format(
+        header['sequence_id'], len(to_write), len(img_id_link), len(to_move)))
+
+    img_uuid_link = {image: image_uuid for image_uuid, image in img_id_link.items()}
+    with open(journal_path, 'a') as journal:
+        print('Writing metadata to EXIF::ImageDescription of remaining images...\n')
+        quarantined = write_descriptions(to_write, img_id_link, journal, telemetry, timeout)
+        clean_up_new_files(OUTPUT_PHOTO_DIRECTORY, [image for image in to_move if image not in quarantined],
+                           journal, img_uuid_link, output_names)
+
+    write_report(header['sequence_id'], header['report'])
+    write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'write', quarantined)
+    if quarantined:
+        print('The journal is kept, use "--resume" again to retry the quarantined images.')
+    else:
+        os.remove(journal_path)
+
+
+def save_sequence(OUTPUT_PHOTO_DIRECTORY, JOURNAL_PATH, sequence_uuid, report_json, descriptions, img_id_link,
+                  existing_descriptions, OUTPUT_MODE, PAYLOAD_FORMAT, skip_unchanged, telemetry, timeout):
+    '''
+    Save the descriptions of a sequence in the requested payload format and output mode, and write the report json.
+    '''
+    # The compact payload refers to the sequence block of the report, which holds the fields shared by all photos
+    if PAYLOAD_FORMAT == 'compact':
+        report_json['sequence'].update(shared_fields(next(iter(descriptions.values()))))
+        descriptions = {image_uuid: encode_compact(description) for image_uuid, description in descriptions.items()}
+
+    # Images of several cameras can share a filename, these are renamed in the output directory
+    output_names = get_output_names(img_id_link.values())
+
+    # Only write images whose description would change, compared with what the last run wrote
+    # to the output directory, or else with the ImageDescription the image holds itself
+    unchanged = set()
+    if skip_unchanged:
+        existing_descriptions = dict(existing_descriptions)
+        existing_descriptions.update(read_written_descriptions(OUTPUT_PHOTO_DIRECTORY, img_id_link, OUTPUT_MODE,
+                                                               timeout, output_names))
+        unchanged = find_unchanged(descriptions, existing_descriptions)
+        print('{0} images already hold their description and are skipped.'.format(len(unchanged)))
+        # A manifest always holds all images, it is written unless nothing changed
+        if OUTPUT_MODE != 'manifest':
+            descriptions = {image_uuid: description for image_uuid, description in descriptions.items()
+                            if image_uuid not in unchanged}
+            img_id_link = {image_uuid: image for image_uuid, image in img_id_link.items()
+                           if image_uuid not in unchanged}
+
+    if not os.path.isdir(OUTPUT_PHOTO_DIRECTORY):
+        os.mkdir(OUTPUT_PHOTO_DIRECTORY)
+
+    if OUTPUT_MODE == 'xmp':
+        write_sidecars(OUTPUT_PHOTO_DIRECTORY, descriptions, img_id_link, output_names)
+        write_report(sequence_uuid, report_json)
+    elif OUTPUT_MODE == 'manifest':
+        if len(unchanged) < len(descriptions):
+            write_manifest(OUTPUT_PHOTO_DIRECTORY, sequence_uuid, descriptions, img_id_link, output_names)
+        else:
+            print('The manifest is unchanged.')
+        write_report(sequence_uuid, report_json)
+    else:
+        # Record the planned descriptions before writing anything, so an interrupted
+        # write phase can be finished with --resume
+        journal = start_journal(JOURNAL_PATH, sequence_uuid, report_json, descriptions, img_id_link, output_names)
+
+        # For each image, write the JSON into EXIF::ImageDescription
+        print('Writing metadata to EXIF::ImageDescription of qualified images...\n')
+        quarantined = write_descriptions(descriptions, img_id_link, journal, telemetry, timeout)
+
+        clean_up_new_files(OUTPUT_PHOTO_DIRECTORY,
+                           [image for image in img_id_link.values() if image not in quarantined], journal,
+                           {image: image_uuid for image_uuid, image in img_id_link.items()}, output_names)
+        journal.close()
+
+        write_report(sequence_uuid, report_json)
+        write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'write', quarantined)
+        if quarantined:
+            print('The journal is kept, use "--resume" to retry the quarantined images.')
+        else:
+            os.remove(JOURNAL_PATH)
+
+
+def write_shard_manifest(shard_manifest_path, report_json, df_images, descriptions, img_id_link,
+                         existing_descriptions):
+    '''
+    Save the result of processing one time-ordered slice of a sequence (a shard) as a partial manifest:
+    the descriptions in order, the images they belong to and the first and last (boundary) frames,
+    which are connected to the neighbouring shards by merge_shards().
+    The boundary positions are the ones the connections were computed from, which include positions
+    added from a GPS track (the original_* fields of those frames are empty).
+    '''
+    order = list(descriptions.keys())
+    df_positions = df_images.set_index('UUID')[['LATITUDE', 'LONGITUDE', 'ALTITUDE']]
+    boundary = {}
+    for side, image_uuid in [('first', order[0]), ('last', order[-1])]:
+        position = df_positions.loc[image_uuid]
+        boundary[side] = {
+            'id': image_uuid,
+            'latitude': float(position['LATITUDE']),
+            'longitude': float(position['LONGITUDE']),
+            'altitude': float(position['ALTITUDE']),
+            'time': report_json['sequence']['earliest_time' if side == 'first' else 'latest_time'],
+        }
+
+    with open(shard_manifest_path, 'w') as outfile:
+        json.dump({
+            'shard': SHARD_MANIFEST_VERSION,
+            'sequence': report_json['sequence'],
+            'order': order,
+            'descriptions': descriptions,
+            'files': img_id_link,
+            'existing_descriptions': {image_uuid: existing_descriptions.get(image_uuid) for image_uuid in order},
+            'boundary': boundary,
+        }, outfile)
+    print('Shard manifest of {0} images saved to {1}'.format(len(order), shard_manifest_path))
+
+
+def read_shard_manifests(shard_directory):
+    '''
+    Read the partial manifests in a directory, ordered by the time of their first frame
+    (or their first filename for the filename connection type).
+    '''
+    shards = []
+    for manifest_path in get_files(shard_directory, False):
+        if not manifest_path.endswith('.json'):
+            continue
+        with open(manifest_path, 'r') as infile:
+            try:
+                manifest = json.load(infile)
+            except ValueError:
+                continue
+        if isinstance(manifest, dict) and manifest.get('shard') == SHARD_MANIFEST_VERSION:
+            shards.append(manifest)
+
+    def shard_key(shard):
+        first_photo = shard['descriptions'][shard['order'][0]]['photo']
+        if first_photo['cli_connection_method'] == 'filename':
+            return ntpath.basename(first_photo['original_filename'])
+        return shard['boundary']['first']['time']
+
+    shards.sort(key=shard_key)
+    for previous, following in zip(shards, shards[1:]):
+        if following['boundary']['first']['time'] < previous['boundary']['last']['time']:
+            print('Warning: shards overlap in time, they should be time-ordered slices of the sequence.')
+    return shards
+
+
+def stitch_boundary(last_description, first_description, last_frame, first_frame):
+    '''
+    Connect the last frame of a shard to the first frame of the next shard, the way
+    make_sequence() connects neighbouring frames: add the NEXT connection of the last frame,
+    the PREVIOUS connection of the first frame, and update the adjusted heading of the last frame.
+    Return the distance between both frames.
+    '''
+    last_photo = last_description['photo']
+    first_photo = first_description['photo']
+
+    distance = haversine(last_frame['longitude'], last_frame['latitude'],
+                         first_frame['longitude'], first_frame['latitude'])
+    delta_alt = first_frame['altitude'] - last_frame['altitude']
+    azimuth = calculate_initial_compass_bearing((last_frame['latitude'], last_frame['longitude']),
+                                                (first_frame['latitude'], first_frame['longitude']))
+    pitch = delta_alt / distance if distance != 0 else float('NaN')
+    delta_time = (datetime.datetime.strptime(first_frame['time'], '%Y:%m:%d %H:%M:%SZ')
+                  - datetime.datetime.strptime(last_frame['time'], '%Y:%m:%d %H:%M:%SZ')).seconds
+
+    # The last frame of a shard had no NEXT image, so its heading was copied from its previous image
+    last_connections = {
+        first_frame['id']: {
+            'distance_mtrs': distance,
+            'elevation_mtrs': delta_alt,
+            'heading_deg': azimuth,
+            'pitch_deg': pitch,
+            'time_sec': delta_time,
+            'speed_kmh': (distance * 3600) / (delta_time * 1000) if delta_time != 0 else 0
+        }
+    }
+    for connection_uuid, connection in last_photo['connections'].items():
+        connection['adj_heading_deg'] = abs(azimuth - connection['heading_deg'])
+        last_connections[connection_uuid] = connection
+    last_photo['connections'] = last_connections
+
+    # The first frame of a shard had no PREVIOUS image
+    heading_to_prev = (azimuth + 180) % 360
+    first_azimuth = next(iter(first_photo['connections'].values()))['heading_deg'] \
+        if first_photo['connections'] else azimuth
+    first_photo['connections'][last_frame['id']] = {
+        'distance_mtrs': -1 * distance,
+        'elevation_mtrs': -1 * delta_alt,
+        'heading_deg': heading_to_prev,
+        'adj_heading_deg': abs(first_azimuth - heading_to_prev),
+        'pitch_deg': -1 * pitch,
+        'time_sec': -1 * delta_time,
+        'speed_kmh': (distance * 3600) / (delta_time * 1000) if delta_time != 0 else 0
+    }
+    return distance
+
+
+def merge_shards(shards, deterministic):
+    '''
+    Merge partial manifests into one sequence: stitch the boundary frames of neighbouring shards
+    and recompute the sequence-level totals. Return the sequence UUID, the report json, the descriptions,
+    the images they belong to and their existing ImageDescriptions, like make_sequence() builds them.
+    '''
+    descriptions = {}
+    img_id_link = {}
+    existing_descriptions = {}
+    for shard in shards:
+        for image_uuid in shard['order']:
+            descriptions[image_uuid] = shard['descriptions'][image_uuid]
+        img_id_link.update(shard['files'])
+        existing_descriptions.update(shard['existing_descriptions'])
+
+    for previous, following in zip(shards, shards[1:]):
+        stitch_boundary(descriptions[previous['order'][-1]], descriptions[following['order'][0]],
+                        previous['boundary']['last'], following['boundary']['first'])
+
+    order = list(descriptions.keys())
+    if deterministic:
+        sequence_uuid = uuid.uuid5(UUID_NAMESPACE, ','.join(order))
+    else:
+        sequence_uuid = uuid.uuid1()
+
+    # As in make_sequence(), the last image counts the distance to its previous image again
+    total_distance = (sum(connection['distance_mtrs']
+                          for image_uuid in order[:-1]
+                          for connection in descriptions[image_uuid]['photo']['connections'].values()
+                          if 'adj_heading_deg' not in connection)
+                      - next(iter(descriptions[order[-1]]['photo']['connections'].values()))['distance_mtrs']) / 1000
+    earliest_time = shards[0]['sequence']['earliest_time']
+    latest_time = shards[-1]['sequence']['latest_time']
+    duration_sec = (datetime.datetime.strptime(latest_time, '%Y:%m:%d %H:%M:%SZ')
+                    - datetime.datetime.strptime(earliest_time, '%Y:%m:%d %H:%M:%SZ')).total_seconds()
+
+    sequence = dict(shards[0]['sequence'])
+    sequence.update({
+        "id": str(sequence_uuid),
+        "distance_km": total_distance,
+        "earliest_time": earliest_time,
+        "latest_time": latest_time,
+        "duration_sec": duration_sec,
+        "average_speed_kmh": total_distance * 3600 / duration_sec if duration_sec != 0 else 0,
+    })
+    report_json = {"sequence": sequence, "photo": {}}
+    for index, image_uuid in enumerate(order):
+        descriptions[image_uuid]['sequence'] = sequence.copy()
+        report_json["photo"][index + 1] = descriptions[image_uuid]['photo'].copy()
+
+    print('{0} shards merged into sequence {1} of {2} images.\n'.format(len(shards), sequence_uuid, len(order)))
+    return sequence_uuid, report_json, descriptions, img_id_link, existing_descriptions
+
+
+def iter_metadata(list_of_files, camera, read_params, telemetry, timeout, target_latency, max_output_bytes,
+                  prefetch_window, prefetch_bytes):
+    '''
+    Read the metadata of the images of one camera (input folder) with their own Exiftool process.
+    For every batch of images read, yield their metadata, and the images that were quarantined, read with warnings
+    or left out by the required tags condition (`read_params`).
+    '''
+    # Several images are read per Exiftool command, sized to the measured latency and output size
+    controller = exiftool.BatchController(target_latency=target_latency, max_output_bytes=max_output_bytes)
+    read_position = 0
+    # Errors are always captured, so that images Exiftool can not read are not taken for images failing the condition
+    with open_exiftool(timeout, capture_errors=True) as et, \
+            HeaderPrefetcher(list_of_files, prefetch_window, prefetch_bytes) as prefetcher:
+        prefetcher.advance(0, controller.size)
+        for batch, batch_metadata, latency, errors in et.get_metadata_batches(list_of_files, controller,
+                                                                               read_params):
+            # The next batch is sent as soon as this loop continues, fetch ahead of it
+            read_position += len(batch)
+            prefetcher.advance(read_position, controller.size)
+            list_of_metadata = []
+            quarantined = {}
+            warnings = {}
+            discarded = []
+
+            # Exiftool leaves out files it can not read, so match the results on their path
+            metadata_by_file = {os.path.normcase(os.path.normpath(metadata['SourceFile'])): metadata
+                                for metadata in batch_metadata}
+            for image in batch:
+                metadata = metadata_by_file.get(os.path.normcase(os.path.normpath(image)))
+                if metadata is None and image in errors:
+                    # Exiftool hung, died or failed on this image: quarantine it
+                    quarantined[image] = errors[image]
+                elif metadata is None and not os.access(image, os.R_OK):
+                    # Where stderr can not be captured (Windows), at least missing or unreadable files are told apart
+                    quarantined[image] = 'The file can not be read'
+                elif metadata is None:
+                    # The image failed the required tags condition
+                    discarded.append(image)
+                else:
+                    if image in errors:
+                        warnings[image] = errors[image]
+                    list_of_metadata.append({'IMAGE_NAME': image, 'CAMERA': camera, 'METADATA': metadata or {}})
+                telemetry.update(image, latency / len(batch))
+            yield list_of_metadata, quarantined, warnings, discarded
+
+
+def read_metadata(*read_settings):
+    '''
+    Read the metadata of the images of one camera (input folder), see iter_metadata().
+    Return the metadata of all images, and the images that were quarantined, read with warnings
+    or left out by the required tags condition.
+    '''
+    list_of_metadata = []
+    quarantined = {}
+    warnings = {}
+    discarded = []
+    for batch_metadata, batch_quarantined, batch_warnings, batch_discarded in iter_metadata(*read_settings):
+        list_of_metadata.extend(batch_metadata)
+        quarantined.update(batch_quarantined)
+        warnings.update(batch_warnings)
+        discarded.extend(batch_discarded)
+    return list_of_metadata, quarantined, warnings, discarded
+
+
+def merge_camera_streams(df_images):
+    '''
+    Return the row order that merges the images of all cameras into one time-ordered sequence.
+    The images of a camera are usually in time order already when sorted by filename, so a camera is
+    only sorted if its images are not; the camera streams are then merged with a k-way merge on GPS_DATETIME.
+    Images taken at the same time follow in camera name order, so the order of the input folders does not matter.
+    '''
+    times = df_images['GPS_DATETIME'].values.astype('datetime64[ns]').astype(np.int64)
+    streams = []
+    for camera_index, positions in enumerate(df_images.groupby('CAMERA', sort=True).indices.values()):
+        if (np.diff(times[positions]) < 0).any():
+            positions = positions[np.argsort(times[positions], kind='stable')]
+        streams.append(zip(times[positions].tolist(), itertools.repeat(camera_index), positions.tolist()))
+    return [position for _, _, position in heapq.merge(*streams)]
+
+
+def get_origin_value(df_row, available_keys):
+    for key in available_keys:
+        if df_row['METADATA'].get(key):
+            return df_row['METADATA'].get(key)
+    return ""
+
+
+def photo_description(k, connection_type, frame_rate, altitude_min, distance_min):
+    '''
+    Return the photo object of the JSON description of a linked image (a row of the image dataframe).
+    The first image has no PREVIOUS and the last image no NEXT connection.
+    '''
+    photo_dict = {
+        "id": k['UUID'],
+        "original_GPSDateTime": k['METADATA'].get('Composite:GPSDateTime'),
+        "original_originalDateTime": k['METADATA'].get('EXIF:DateTimeOriginal'),
+        "cli_connection_method": connection_type,
+        "cli_frame_rate_set": frame_rate,
+        "cli_altitude_min_set": altitude_min,
+        "cli_distance_min_set": distance_min,
+        "original_filename": k['IMAGE_NAME'],
+        "original_altitude": k['METADATA'].get('Composite:GPSAltitude'),
+        "original_latitude": k['METADATA'].get('Composite:GPSLatitude'),
+        "original_longitude": k['METADATA'].get('Composite:GPSLongitude'),
+        "orignal_gps_direction_ref": k['METADATA'].get('EXIF:GPSImgDirectionRef', ""),
+        "orignal_gps_speed": k['METADATA'].get('EXIF:GPSSpeed', ""),
+        "original_heading": get_origin_value(k, ["XMP:PoseHeadingDegrees", "EXIF:GPSImgDirection"]),
+        "original_pitch": get_origin_value(k, ["XMP:PosePitchDegrees", "EXIF:GPSPitch"]),
+        "original_roll": get_origin_value(k, ["XMP:PosePoseRollDegrees", "EXIF:GPSRoll"]),
+        "original_camera_make": k['METADATA'].get('EXIF:Make'),
+        "original_camera_model": k['METADATA'].get('EXIF:Model'),
+        "original_camera_source": k['CAMERA'],
+        "original_projection": k['METADATA'].get('XMP:ProjectionType'),
+        "software_version": 1.0,  # shows version of sequence maker used from version txt,
+        "uploader_photo_from_video": None,  # not currently used,
+        "uploader_nadir_added": None,  # not currently used,
+        "uploader_blur_added": None,  # not currently used,
+        "uploader_gps_track_added": True if k['GPS_TRACK_ADDED'] else None,
+        "uploader_gps_modified": None,  # not currently used,
+        "uploader_tags": None, # not currently used
+        'connections': {
+            k['UUID_NEXT']: {
+                'distance_mtrs': k['DISTANCE'],
+                'elevation_mtrs': k['DELTA_ALT'],
+                'heading_deg': k['AZIMUTH'],
+                'pitch_deg': k['PITCH'],
+                'time_sec': k['DELTA_TIME'],
+                'speed_kmh': (k['DISTANCE'] * 3600) / (k['DELTA_TIME'] * 1000) if k[
+                                                                                      'DELTA_TIME'] != 0 else 0
+            },
+
+            k['UUID_PREV']: {
+                'distance_mtrs': k['DISTANCE_TO_PREV'],
+                'elevation_mtrs': k['DELTA_ALT_TO_PREV'],
+                'heading_deg': k['AZIMUTH_TO_PREV'],
+                'adj_heading_deg': abs(k['AZIMUTH'] - k['AZIMUTH_TO_PREV']),
+                'pitch_deg': k['PITCH_TO_PREV'],
+                'time_sec': k['DELTA_TIME_TO_PREV'],
+                'speed_kmh': (k['DISTANCE_TO_PREV'] * 3600) / (k['DELTA_TIME_TO_PREV'] * 1000) if k['DELTA_TIME_TO_PREV'] != 0 else 0
+            }
+        }
+    }
+    # Remove the 'nan' links of the first image to its PREVIOUS, and
+    # the NEXT image of the last image
+    photo_dict['connections'] = {connection: values for connection, values in photo_dict['connections'].items()
+                                 if type(connection) != float}
+    return photo_dict
+
+
+def sequence_summary(sequence_uuid, earliest_time, latest_time, total_distance):
+    '''
+    Return the sequence block of the report json and the JSON descriptions.
+    '''
+    duration_sec = (latest_time - earliest_time).total_seconds()
+    return {
+        "id": str(sequence_uuid),
+        "distance_km": total_distance,
+        "earliest_time": earliest_time.strftime('%Y:%m:%d %H:%M:%SZ'),
+        "latest_time": latest_time.strftime('%Y:%m:%d %H:%M:%SZ'),
+        "duration_sec": duration_sec,
+        "average_speed_kmh": total_distance * 3600 / duration_sec if duration_sec != 0 else 0,
+        "uploader_sequence_name": None, # not currently used
+        "uploader_sequence_description": None,# not currently used
+        "uploader_transport_type": None# not currently used
+    }
+
+
 def handle_frame_rate(frame_rate):
     '''
     Helper function to process frame rates and invalid values
@@ -237,6 +1403,480 @@ def handle_frame_rate(frame_rate):
             return MAX_FRAME_RATE, MIN_TIME_INTERVAL
 
 
+class HeaderPrefetcher(object):
+    '''
+    Read the header region of upcoming images from a thread pool while Exiftool parses the current ones,
+    so on network storage the round trip to fetch a file overlaps with parsing instead of adding to it.
+    The operating system is told the region will be needed (posix_fadvise, where available),
+    and it is read once so it sits in the page cache when Exiftool opens the file.
+    At most `window` files ahead of the read position are fetched, `header_bytes` of each.
+    '''
+
+    def __init__(self, list_of_files, window=16, header_bytes=128 * 1024):
+        self.list_of_files = list_of_files
+        self.window = window
+        self.header_bytes = header_bytes
+        self.scheduled = 0
+        self.closed = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(window, 16))) \
+            if window > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.closed = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def fetch(self, image):
+        if self.closed:
+            return
+        try:
+            with open(image, 'rb') as infile:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(infile.fileno(), 0, self.header_bytes, os.POSIX_FADV_WILLNEED)
+                infile.read(self.header_bytes)
+        except OSError:
+            # The image will be reported when Exiftool reads it
+            pass
+
+    def advance(self, position, upcoming=0):
+        '''
+        Schedule the files after `position` (plus the `upcoming` ones about to be read) up to the window.
+        '''
+        if self.executor is None:
+            return
+        until = min(position + upcoming + self.window, len(self.list_of_files))
+        while self.scheduled < until:
+            self.executor.submit(self.fetch, self.list_of_files[self.scheduled])
+            self.scheduled += 1
+
+
+class Telemetry(object):
+    '''
+    Track the throughput of the long running stages (metadata read, metadata write).
+    For the current stage it keeps images/sec, bytes/sec, Exiftool latency percentiles and the ETA,
+    prints them to the console every `interval` seconds and, if a path is given,
+    writes them in the Prometheus text format for the node_exporter textfile collector.
+    '''
+
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    def __init__(self, interval=5, textfile=None):
+        self.interval = interval
+        self.textfile = textfile
+        self.stages = {}
+        self.stage = None
+        # The input folders are read concurrently
+        self.lock = threading.Lock()
+
+    def start_stage(self, stage, total):
+        self.stage = stage
+        self.stages[stage] = {
+            'total': total,
+            'images': 0,
+            'bytes': 0,
+            'latencies': [],
+            'started': time.monotonic(),
+            'elapsed': 0.0,
+        }
+        self.last_report = time.monotonic()
+        self.write_textfile()
+
+    def update(self, image, latency):
+        '''
+        Record one image of the current stage and the time Exiftool took for it.
+        '''
+        with self.lock:
+            self._update(image, latency)
+
+    def _update(self, image, latency):
+        stats = self.stages[self.stage]
+        stats['images'] += 1
+        try:
+            stats['bytes'] += os.path.getsize(image)
+        except OSError:
+            pass
+        stats['latencies'].append(latency)
+        stats['elapsed'] = time.monotonic() - stats['started']
+
+        if self.interval and time.monotonic() - self.last_report >= self.interval:
+            self.last_report = time.monotonic()
+            print(self.format_stage(self.stage))
+            self.write_textfile()
+
+    def finish_stage(self):
+        stats = self.stages[self.stage]
+        stats['elapsed'] = time.monotonic() - stats['started']
+        print(self.format_stage(self.stage) + '\n')
+        self.write_textfile()
+
+    def rates(self, stage):
+        stats = self.stages[stage]
+        if stats['elapsed'] <= 0:
+            return 0, 0, None
+        images_per_sec = stats['images'] / stats['elapsed']
+        bytes_per_sec = stats['bytes'] / stats['elapsed']
+        eta = (stats['total'] - stats['images']) / images_per_sec if images_per_sec > 0 else None
+        return images_per_sec, bytes_per_sec, eta
+
+    def latency_quantiles(self, stage):
+        latencies = sorted(self.stages[stage]['latencies'])
+        if not latencies:
+            return {quantile: 0 for quantile in self.QUANTILES}
+        return {quantile: latencies[min(int(quantile * len(latencies)), len(latencies) - 1)]
+                for quantile in self.QUANTILES}
+
+    def format_stage(self, stage):
+        stats = self.stages[stage]
+        images_per_sec, bytes_per_sec, eta = self.rates(stage)
+        quantiles = self.latency_quantiles(stage)
+        return '{0}: {1}/{2} images ({3:.1f}%) | {4:.1f} images/s | {5:.1f} MB/s | ' \
+               'exiftool p50 {6:.0f} ms, p90 {7:.0f} ms, p99 {8:.0f} ms | ETA {9}'.format(
+                   stage, stats['images'], stats['total'],
+                   100 * stats['images'] / stats['total'] if stats['total'] else 100,
+                   images_per_sec, bytes_per_sec / 1000000,
+                   *[quantiles[quantile] * 1000 for quantile in self.QUANTILES],
+                   datetime.timedelta(seconds=round(eta)) if eta is not None else '-')
+
+    def write_textfile(self):
+        '''
+        Write all stages seen so far to the Prometheus textfile.
+        The file is replaced atomically so the collector never reads a partial file.
+        '''
+        if not self.textfile:
+            return
+
+        lines = []
+        metrics = [
+            ('sequence_maker_stage_images', 'gauge', 'Images to process in the stage.'),
+            ('sequence_maker_images_processed_total', 'counter', 'Images processed in the stage.'),
+            ('sequence_maker_bytes_processed_total', 'counter', 'Bytes of the images processed in the stage.'),
+            ('sequence_maker_images_per_second', 'gauge', 'Average images per second of the stage.'),
+            ('sequence_maker_bytes_per_second', 'gauge', 'Average bytes per second of the stage.'),
+            ('sequence_maker_eta_seconds', 'gauge', 'Estimated seconds until the stage completes.'),
+            ('sequence_maker_exiftool_latency_seconds', 'summary', 'Exiftool latency per image.'),
+        ]
+        for name, metric_type, description in metrics:
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for stage, stats in self.stages.items():
+                images_per_sec, bytes_per_sec, eta = self.rates(stage)
+                values = {
+                    'sequence_maker_stage_images': stats['total'],
+                    'sequence_maker_images_processed_total': stats['images'],
+                    'sequence_maker_bytes_processed_total': stats['bytes'],
+                    'sequence_maker_images_per_second': images_per_sec,
+                    'sequence_maker_bytes_per_second': bytes_per_sec,
+                    'sequence_maker_eta_seconds': eta if eta is not None else 0,
+                }
+                if name in values:
+                    lines.append('{0}{{stage="{1}"}} {2}'.format(name, stage, values[name]))
+                else:
+                    for quantile, latency in self.latency_quantiles(stage).items():
+                        lines.append('{0}{{stage="{1}",quantile="{2}"}} {3}'.format(name, stage, quantile, latency))
+                    lines.append('{0}_sum{{stage="{1}"}} {2}'.format(name, stage, sum(stats['latencies'])))
+                    lines.append('{0}_count{{stage="{1}"}} {2}'.format(name, stage, len(stats['latencies'])))
+        lines.append('# HELP sequence_maker_last_update_timestamp_seconds Time the metrics were last written.')
+        lines.append('# TYPE sequence_maker_last_update_timestamp_seconds gauge')
+        lines.append('sequence_maker_last_update_timestamp_seconds {0}'.format(time.time()))
+
+        tmp_path = '{0}.{1}.tmp'.format(self.textfile, os.getpid())
+        with open(tmp_path, 'w') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.textfile)
+
+
+def description_hash(description):
+    '''
+    Return a hash of an ImageDescription payload, leaving out the volatile fields
+    which can differ between runs while the connections of the image are the same.
+    '''
+    photo = {key: value for key, value in description.get('photo', {}).items()
+             if key not in VOLATILE_PHOTO_FIELDS}
+    canonical = json.dumps({'photo': photo, 'sequence': description.get('sequence')}, sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def read_written_descriptions(OUTPUT_PHOTO_DIRECTORY, img_id_link, OUTPUT_MODE, timeout=0, output_names=None):
+    '''
+    Return the descriptions an earlier run wrote to the output directory for these images:
+    the ImageDescription of their _calculated copy, their XMP sidecar or their entry in a manifest.
+    Images without one are left out.
+    '''
+    written = {}
+    if OUTPUT_MODE == 'images':
+        calculated_uuid_link = {get_calculated_file_name(OUTPUT_PHOTO_DIRECTORY, image, output_names): image_uuid
+                                for image_uuid, image in img_id_link.items()}
+        calculated_files = [calculated for calculated in calculated_uuid_link if os.path.isfile(calculated)]
+        if calculated_files:
+            with open_exiftool(timeout) as et:
+                for _, batch_metadata, _, _ in et.get_metadata_batches(calculated_files,
+                                                                       params=('-EXIF:ImageDescription',)):
+                    for metadata in batch_metadata:
+                        calculated = os.path.abspath(metadata['SourceFile'])
+                        if calculated in calculated_uuid_link and 'EXIF:ImageDescription' in metadata:
+                            written[calculated_uuid_link[calculated]] = metadata['EXIF:ImageDescription']
+    elif OUTPUT_MODE == 'xmp':
+        for image_uuid, image in img_id_link.items():
+            sidecar = get_sidecar_file_name(OUTPUT_PHOTO_DIRECTORY, image, output_names)
+            if not os.path.isfile(sidecar):
+                continue
+            with open(sidecar, 'r', encoding='utf-8') as infile:
+                match = re.search(r'<rdf:li xml:lang="x-default">(.*?)</rdf:li>', infile.read(), re.DOTALL)
+            if match:
+                written[image_uuid] = xml.sax.saxutils.unescape(match.group(1))
+    else:
+        # The latest manifest holding an image wins
+        manifest_paths = [os.path.join(OUTPUT_PHOTO_DIRECTORY, manifest_name)
+                          for manifest_name in os.listdir(OUTPUT_PHOTO_DIRECTORY)
+                          if manifest_name.endswith('_manifest.json')] if os.path.isdir(OUTPUT_PHOTO_DIRECTORY) else []
+        manifest = {}
+        for manifest_path in sorted(manifest_paths, key=os.path.getmtime):
+            with open(manifest_path, 'r') as infile:
+                try:
+                    manifest.update(json.load(infile))
+                except ValueError:
+                    continue
+        for image_uuid, image in img_id_link.items():
+            if get_output_name(image, output_names) in manifest:
+                written[image_uuid] = manifest[get_output_name(image, output_names)]
+    return written
+
+
+def find_unchanged(descriptions, existing_descriptions):
+    '''
+    Return the UUIDs of the images whose EXIF:ImageDescription already holds the planned description.
+    The existing description comes from the metadata read or the output directory (see read_written_descriptions()),
+    as a JSON string or already parsed.
+    '''
+    unchanged = set()
+    for image_uuid, description in descriptions.items():
+        existing = existing_descriptions.get(image_uuid)
+        if isinstance(existing, str):
+            try:
+                existing = json.loads(existing)
+            except ValueError:
+                continue
+        # Payloads are compared in their full form, a change of payload format is a change
+        if isinstance(existing, dict) and description_hash(decode_description(existing)) == \
+                description_hash(decode_description(description)):
+            unchanged.add(image_uuid)
+    return unchanged
+
+
+def assign_uuids(df_images, deterministic, key_counts=None):
+    '''
+    Assign a UUID to every image and return the UUID of the sequence.
+    Deterministic UUIDs are uuid5's of the filename in the output directory (with the camera for filenames
+    used by several cameras, see get_output_names()) and the capture time and position, and the sequence UUID
+    is derived from the photo UUIDs, so rerunning on the same images gives the same IDs, whatever the order of
+    the input folders. Nothing the write changes is used (not the file size, and not the _calculated suffix
+    of the output files), so rerunning on the output images gives the same IDs as well.
+    To assign the UUIDs of one sequence over several calls (the windows of stream_sequence()), pass the same
+    key_counts to every call: it maps the filenames (without _calculated suffix) of several images of the
+    sequence to a collections.Counter of their keys seen so far. Only these images can repeat a key of an
+    earlier call, as the filenames of a folder are unique.
+    '''
+    if not deterministic:
+        df_images['UUID'] = [str(uuid.uuid1()) for _ in range(len(df_images))]
+        return uuid.uuid1()
+
+    output_names = get_output_names(df_images['IMAGE_NAME'])
+    image_names = df_images['IMAGE_NAME'].map(lambda image: get_original_file_name(get_output_name(image, output_names)))
+    keys = image_names \
+        + '|' + df_images['GPS_DATETIME'].dt.strftime('%Y-%m-%dT%H:%M:%S') \
+        + '|' + df_images['LATITUDE'].map('{0:.7f}'.format) \
+        + '|' + df_images['LONGITUDE'].map('{0:.7f}'.format)
+    # Identical keys (e.g. copies of one image) still get distinct UUIDs
+    occurrences = keys.groupby(keys).cumcount()
+    if key_counts:
+        repeatable = [(position, image_name, key) for position, (image_name, key) in enumerate(zip(image_names, keys))
+                      if image_name in key_counts]
+        occurrences = occurrences.values.copy()
+        for position, image_name, key in repeatable:
+            occurrences[position] += key_counts[image_name][key]
+        for position, image_name, key in repeatable:
+            key_counts[image_name][key] += 1
+        occurrences = pd.Series(occurrences, index=keys.index)
+    keys = keys + '|' + occurrences.astype(str)
+    df_images['UUID'] = [str(uuid.uuid5(UUID_NAMESPACE, key)) for key in keys]
+
+    return uuid.uuid5(UUID_NAMESPACE, ','.join(df_images['UUID']))
+
+
+def parse_gps_datetime(value):
+    '''
+    Convert a GPSDateTime (UTC, ending in Z) or DateTimeOriginal value to a datetime.
+    '''
+    if 'Z' in value:
+        return datetime.datetime.strptime(value, '%Y:%m:%d %H:%M:%SZ')
+    return datetime.datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
+
+
+def stream_sequence(OUTPUT_PHOTO_DIRECTORY, list_of_files, keys, read_settings, window_size, filter_intervals,
+                    photo_settings, deterministic, OUTPUT_MODE, skip_unchanged, telemetry, timeout):
+    '''
+    Make the sequence of images that are already in sequence order (their filenames sort in time order)
+    in windows of `window_size` images: read, filter, link and write a window before reading on,
+    so memory use does not grow with the number of images and the first images are written early.
+
+    The last kept image of a window is written with the next window, once its NEXT image is known,
+    and the last image read is carried over to filter the next window from (see fused_filter()).
+    The payloads are compact: the sequence totals are only known at the end, so they are only in the report json.
+    The images carry the sequence UUID, so it is set before the first window: with deterministic ids, it is
+    derived from the filenames of all images and the settings that decide which images are kept and how they
+    are connected, so a run on other images or with other filters does not get the same sequence UUID.
+    Images missing required metadata are always discarded, as earlier windows are already written when they are found.
+    `read_settings` are the arguments of iter_metadata() after the list of files.
+    Return the report json file (None if less than two images are left), the images that were quarantined
+    or read with warnings, the images left out by the required tags condition, and the images that
+    could not be written.
+    '''
+    if deterministic:
+        sequence_hash = hashlib.sha1(json.dumps([filter_intervals, photo_settings], default=str).encode('utf-8'))
+        for image in list_of_files:
+            sequence_hash.update(get_original_file_name(image).encode('utf-8') + b'\n')
+        sequence_uuid = uuid.uuid5(UUID_NAMESPACE, sequence_hash.hexdigest())
+    else:
+        sequence_uuid = uuid.uuid1()
+    print('Sequence {0}'.format(sequence_uuid))
+    carry = {}
+    overlap = None
+    linked = None
+    window = []
+    # Images whose filename only differs by a _calculated suffix can have the same UUID key in different windows
+    name_counts = collections.Counter(get_original_file_name(image) for image in list_of_files)
+    key_counts = {image_name: collections.Counter() for image_name, count in name_counts.items() if count > 1}
+    del name_counts
+    summary = {'photos': 0, 'distance': 0.0, 'earliest_time': None, 'latest_time': None, 'shared': None,
+               'time_warning': False}
+    quarantined = {}
+    read_quarantined = {}
+    read_warnings = {}
+    preflight_discarded = []
+    # The photo objects of the report are collected on disk, the sequence block is only known at the end
+    photos_file = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+
+    def write_linked(df_linked, rows):
+        descriptions = {}
+        img_id_link = {}
+        existing_descriptions = {}
+        for index, k in df_linked.iloc[list(rows)].iterrows():
+            photo_dict = photo_description(k, *photo_settings)
+            description = {"photo": photo_dict, "sequence": {"id": str(sequence_uuid)}}
+            if summary['shared'] is None:
+                summary['shared'] = shared_fields(description)
+            descriptions[k['UUID']] = encode_compact(description)
+            img_id_link[k['UUID']] = k['IMAGE_NAME']
+            existing_descriptions[k['UUID']] = k['METADATA'].get('EXIF:ImageDescription')
+
+            summary['photos'] += 1
+            summary['distance'] += k['DISTANCE']
+            if summary['earliest_time'] is None:
+                summary['earliest_time'] = k['GPS_DATETIME']
+            summary['latest_time'] = k['GPS_DATETIME']
+            photos_file.write('{0}{1}: {2}'.format(', ' if summary['photos'] > 1 else '',
+                                                   json.dumps(str(summary['photos'])), json.dumps(photo_dict)))
+
+        if skip_unchanged:
+            existing_descriptions.update(read_written_descriptions(OUTPUT_PHOTO_DIRECTORY, img_id_link, OUTPUT_MODE,
+                                                                   timeout))
+            unchanged = find_unchanged(descriptions, existing_descriptions)
+            descriptions = {image_uuid: description for image_uuid, description in descriptions.items()
+                            if image_uuid not in unchanged}
+            img_id_link = {image_uuid: image for image_uuid, image in img_id_link.items()
+                           if image_uuid not in unchanged}
+        if OUTPUT_MODE == 'xmp':
+            write_sidecars(OUTPUT_PHOTO_DIRECTORY, descriptions, img_id_link)
+        elif descriptions:
+            window_quarantined = write_descriptions(descriptions, img_id_link, timeout=timeout, et=write_et)
+            clean_up_new_files(OUTPUT_PHOTO_DIRECTORY,
+                               [image for image in img_id_link.values() if image not in window_quarantined])
+            quarantined.update(window_quarantined)
+        print('{0} images written ({1} so far)\n'.format(len(descriptions), summary['photos']))
+
+    def process_window(window):
+        nonlocal overlap, linked
+        df_window = pd.DataFrame(window)
+        df_window[['LATITUDE', 'LONGITUDE', 'ALTITUDE', 'GPS_DATETIME']] = df_window.apply(
+            lambda x: parse_metadata(x, keys, True), axis=1, result_type='expand')
+        df_window = df_window.dropna(axis=0, how='any').reset_index(drop=True)
+        if len(df_window) == 0:
+            return
+        df_window['GPS_TRACK_ADDED'] = False
+        df_window['GPS_DATETIME'] = df_window.apply(lambda x: parse_gps_datetime(x['GPS_DATETIME']), axis=1)
+
+        # Filter from the last image of the previous window
+        df_filter = df_window if overlap is None else pd.concat([overlap, df_window], ignore_index=True)
+        if not summary['time_warning'] and (np.diff(df_filter['GPS_DATETIME'].values) < np.timedelta64(0)).any():
+            print('Warning: the filenames are not in time order, the images are connected in filename order.')
+            summary['time_warning'] = True
+        kept = fused_filter(df_filter, *filter_intervals, carry=carry)
+        overlap = df_window.iloc[[-1]]
+        df_kept = df_filter.iloc[kept].reset_index(drop=True)
+        if len(df_kept) == 0:
+            return
+        assign_uuids(df_kept, deterministic, key_counts)
+
+        # The last two kept images of the previous window: the one before the held image, and the held image
+        finalised = 0 if linked is None else len(linked) - 1
+        df_linked = df_kept if linked is None else pd.concat([linked[df_kept.columns], df_kept],
+                                                             ignore_index=True)
+        linked = df_linked
+        if len(df_linked) < 2:
+            return
+        df_linked = link_images(df_linked)
+        df_linked['UUID_NEXT'] = df_linked['UUID'].shift(-1)
+        df_linked['UUID_PREV'] = df_linked['UUID'].shift(1)
+        write_linked(df_linked, range(finalised, len(df_linked) - 1))
+        linked = df_linked.iloc[-2:].reset_index(drop=True)
+
+    if not os.path.isdir(OUTPUT_PHOTO_DIRECTORY):
+        os.mkdir(OUTPUT_PHOTO_DIRECTORY)
+    telemetry.start_stage('read', len(list_of_files))
+    with (open_exiftool(timeout) if OUTPUT_MODE == 'images' else contextlib.nullcontext()) as write_et:
+        for batch_metadata, batch_quarantined, batch_warnings, batch_discarded in iter_metadata(list_of_files,
+                                                                                               *read_settings):
+            read_quarantined.update(batch_quarantined)
+            read_warnings.update(batch_warnings)
+            preflight_discarded.extend(batch_discarded)
+            window.extend(batch_metadata)
+            while len(window) >= window_size:
+                process_window(window[:window_size])
+                window = window[window_size:]
+        if window:
+            process_window(window)
+
+        # The last kept image has no NEXT image
+        if linked is not None and len(linked) == 2:
+            df_linked = link_images(linked.reset_index(drop=True))
+            df_linked['UUID_NEXT'] = df_linked['UUID'].shift(-1)
+            df_linked['UUID_PREV'] = df_linked['UUID'].shift(1)
+            write_linked(df_linked, [1])
+    telemetry.finish_stage()
+    photos_file.seek(0)
+
+    report_path = None
+    if summary['photos'] >= 2:
+        report_sequence = sequence_summary(sequence_uuid, summary['earliest_time'], summary['latest_time'],
+                                           summary['distance'] / 1000)
+        report_sequence.update(summary['shared'])
+        report_path = "{}.json".format(sequence_uuid)
+        print('Writing report json')
+        with open(report_path, "w") as outfile:
+            outfile.write('{{"sequence": {0}, "photo": {{'.format(json.dumps(report_sequence)))
+            while True:
+                chunk = photos_file.read(1024 * 1024)
+                if not chunk:
+                    break
+                outfile.write(chunk)
+            outfile.write('}}')
+    photos_file.close()
+    return report_path, read_quarantined, read_warnings, preflight_discarded, quarantined
+
+
 def make_sequence(args):
     '''
     You define the timelapse series of photos, desired photo spacing (by distance or capture time), and how they should be connected
@@ -254,6 +1894,53 @@ def make_sequence(args):
     connection_type = args.connection_type.lower()
     CONNECTION_TYPE = 'GPS_DATETIME' if connection_type in ['timegps', 'timecapture'] else 'IMAGE_NAME'
     DISCARD = True if args.discard == True else False
+    OUTPUT_MODE = args.output_mode.lower()
+    PAYLOAD_FORMAT = args.payload_format.lower()
+    TABLE_FORMATS = [table_format.strip() for table_format in args.export_table.lower().split(',')
+                     if table_format.strip()]
+    if any(table_format not in ['parquet', 'arrow', 'feather'] for table_format in TABLE_FORMATS):
+        input('Invalid table format in {0}. Use parquet, arrow and/or feather.\nPress any key to quit'.format(
+            args.export_table))
+        quit()
+    if TABLE_FORMATS:
+        try:
+            import pyarrow
+        except ImportError:
+            input('Exporting the sequence table requires pyarrow: python -m pip install pyarrow\nPress any key to quit')
+            quit()
+    if PAYLOAD_FORMAT not in ['full', 'compact']:
+        input('Invalid payload format {0}. Use full or compact.\nPress any key to quit'.format(PAYLOAD_FORMAT))
+        quit()
+    if OUTPUT_MODE not in ['images', 'xmp', 'manifest']:
+        input('Invalid output mode {0}. Use images, xmp or manifest.\nPress any key to quit'.format(OUTPUT_MODE))
+        quit()
+
+    STREAM_WINDOW = int(args.stream_window)
+    if STREAM_WINDOW > 0:
+        unsupported = [option for option, used in [
+            ('-o manifest', OUTPUT_MODE == 'manifest'), ('-c spatial', connection_type == 'spatial'),
+            ('several input folders', len(args.input_directory) > 1), ('-g', bool(args.track_log)),
+            ('-t', bool(TABLE_FORMATS)), ('-x', args.graph_index),
+            ('--shard-manifest', bool(args.shard_manifest)), ('-m', args.merge_shards), ('-r', args.resume)] if used]
+        if unsupported:
+            input('The streaming mode (-w) can not be combined with {0}.\nPress any key to quit'.format(
+                ', '.join(unsupported)))
+            quit()
+        # Earlier windows are written before an image missing required metadata can be found
+        if not DISCARD:
+            input('The streaming mode (-w) requires -d: images missing required metadata can only be found '
+                  'after earlier images were written, so they are discarded.\nPress any key to quit')
+            quit()
+        # The sequence totals are only known at the end, the payloads refer to the report instead
+        PAYLOAD_FORMAT = 'compact'
+
+    # A shard stops before the sequence is complete, and a merge only has the descriptions of the images
+    if args.shard_manifest or args.merge_shards:
+        unsupported = [option for option, used in [('-t', bool(TABLE_FORMATS)), ('-x', args.graph_index)] if used]
+        if unsupported:
+            input('Shards (--shard-manifest and -m) can not be combined with {0}.\nPress any key to quit'.format(
+                ', '.join(unsupported)))
+            quit()
 
     MAX_FRAME_RATE, MIN_TIME_INTERVAL = handle_frame_rate(args.frame_rate)
 
@@ -265,22 +1952,26 @@ def make_sequence(args):
     ALTITUDE_FITLERING = True if MIN_ALTITUDE_INTERVAL > 0 else False
 
     PATH = Path(__file__)
-    INPUT_PHOTO_DIRECTORY = os.path.abspath(args.input_directory)
+    INPUT_PHOTO_DIRECTORIES = []
     OUTPUT_PHOTO_DIRECTORY = os.path.abspath(args.output_directory)
 
-    if not os.path.isdir(os.path.abspath(INPUT_PHOTO_DIRECTORY)):
-        if os.path.isdir(os.path.join(PATH.parent.resolve(), INPUT_PHOTO_DIRECTORY)):
-            INPUT_PHOTO_DIRECTORY = os.path.join(PATH.parent.resolve(), INPUT_PHOTO_DIRECTORY)
-            if not os.path.isdir(os.path.abspath(OUTPUT_PHOTO_DIRECTORY)):
-                OUTPUT_PHOTO_DIRECTORY = os.path.join(PATH.parent.resolve(), OUTPUT_PHOTO_DIRECTORY)
-        else:
-            input('No valid input folder is given!\nInput folder {0} or {1} does not exist!'.format(
-                os.path.abspath(INPUT_PHOTO_DIRECTORY), \
-                os.path.abspath(os.path.join(PATH.parent.resolve(), INPUT_PHOTO_DIRECTORY))))
-            input('Press any key to continue')
-            quit()
+    for input_directory in args.input_directory:
+        INPUT_PHOTO_DIRECTORY = os.path.abspath(input_directory)
+        if not os.path.isdir(os.path.abspath(INPUT_PHOTO_DIRECTORY)):
+            if os.path.isdir(os.path.join(PATH.parent.resolve(), INPUT_PHOTO_DIRECTORY)):
+                INPUT_PHOTO_DIRECTORY = os.path.join(PATH.parent.resolve(), INPUT_PHOTO_DIRECTORY)
+                if not os.path.isdir(os.path.abspath(OUTPUT_PHOTO_DIRECTORY)):
+                    OUTPUT_PHOTO_DIRECTORY = os.path.join(PATH.parent.resolve(), OUTPUT_PHOTO_DIRECTORY)
+            else:
+                input('No valid input folder is given!\nInput folder {0} or {1} does not exist!'.format(
+                    os.path.abspath(INPUT_PHOTO_DIRECTORY), \
+                    os.path.abspath(os.path.join(PATH.parent.resolve(), INPUT_PHOTO_DIRECTORY))))
+                input('Press any key to continue')
+                quit()
+        INPUT_PHOTO_DIRECTORIES.append(INPUT_PHOTO_DIRECTORY)
+    INPUT_PHOTO_DIRECTORY = INPUT_PHOTO_DIRECTORIES[0]
 
-    print('The following input folder will be used:\n{0}'.format(INPUT_PHOTO_DIRECTORY))
+    print('The following input folder will be used:\n{0}'.format('\n'.join(INPUT_PHOTO_DIRECTORIES)))
     print('The following output folder will be used:\n{0}'.format(OUTPUT_PHOTO_DIRECTORY))
 
     # Often the exiftool.exe will not be in Windows's PATH
@@ -298,32 +1989,203 @@ def make_sequence(args):
     else:
         exiftool.executable = args.executable_path
 
-    # Get files in directory
-    list_of_files = get_files(INPUT_PHOTO_DIRECTORY, False)
+    telemetry = Telemetry(float(args.progress_interval), args.prometheus_textfile)
+    EXIFTOOL_TIMEOUT = float(args.exiftool_timeout)
+
+    # Finish an interrupted run, or refuse to start over one
+    JOURNAL_PATH = os.path.join(OUTPUT_PHOTO_DIRECTORY, JOURNAL_FILENAME)
+    if args.resume:
+        resume_sequence(OUTPUT_PHOTO_DIRECTORY, JOURNAL_PATH, telemetry, EXIFTOOL_TIMEOUT)
+        input('\nMetadata successfully added to images.\n\nPress any key to quit')
+        quit()
+    elif os.path.isfile(JOURNAL_PATH):
+        print('An unfinished run was found in {0}.'.format(OUTPUT_PHOTO_DIRECTORY))
+        print('Use the "--resume" option to finish it, or delete {0} to start over.'.format(JOURNAL_PATH))
+        input('Press any key to quit')
+        quit()
+
+    # Merge mode: the input folder holds the partial manifests written by the shards
+    if args.merge_shards:
+        shards = read_shard_manifests(INPUT_PHOTO_DIRECTORY)
+        if not shards:
+            print('No shard manifests found in {0}. Exiting program.'.format(INPUT_PHOTO_DIRECTORY))
+            input('Press any key to quit')
+            quit()
+        sequence_uuid, report_json, descriptions, img_id_link, existing_descriptions = \
+            merge_shards(shards, args.deterministic_ids)
+        collisions = find_output_collisions(list(img_id_link.values()))
+        if collisions:
+            input('Shards in folders with the same name hold images with the same filename ({0}), their output files '
+                  'would overwrite each other. Rename the folders.\nPress any key to quit'.format(', '.join(collisions[:5])))
+            quit()
+        save_sequence(OUTPUT_PHOTO_DIRECTORY, JOURNAL_PATH, sequence_uuid, report_json, descriptions, img_id_link,
+                      existing_descriptions, OUTPUT_MODE, PAYLOAD_FORMAT, args.skip_unchanged, telemetry,
+                      EXIFTOOL_TIMEOUT)
+        input('\nMetadata successfully added to images.\n\nPress any key to quit')
+        quit()
+
+    # Track logs to geotag images without GPS tags from
+    TRACK_LOGS = args.track_log or []
+    TRACK_OFFSET = float(args.track_offset)
+    TRACK_MAX_GAP = float(args.track_max_gap)
+    if TRACK_LOGS:
+        try:
+            track = read_track_logs(TRACK_LOGS)
+        except (OSError, ValueError, xml.etree.ElementTree.ParseError) as e:
+            print('The track logs could not be read: {0}'.format(e))
+            input('Press any key to quit')
+            quit()
+        print('{0} track points have been read from {1} track log(s)'.format(len(track), len(TRACK_LOGS)))
+
+    # Get files in directories, each input folder is the stream of one camera
+    cameras = [os.path.basename(directory) for directory in INPUT_PHOTO_DIRECTORIES]
+    if len(set(cameras)) < len(cameras):
+        cameras = INPUT_PHOTO_DIRECTORIES
+    files_by_camera = {camera: sorted(get_files(directory, False))
+                       for camera, directory in zip(cameras, INPUT_PHOTO_DIRECTORIES)}
+    list_of_files = [image for files_of_camera in files_by_camera.values() for image in files_of_camera]
     print('{0} file(s) have been found in input directory'.format(len(list_of_files)))
+    # Filenames shared by several cameras are prefixed with the folder name in the output directory,
+    # which only tells the images apart if the folder names differ
+    collisions = find_output_collisions(list_of_files)
+    if collisions:
+        input('Input folders with the same name hold images with the same filename ({0}), their output files '
+              'would overwrite each other. Rename the folders.\nPress any key to quit'.format(', '.join(collisions[:5])))
+        quit()
+
+    # Metadata keys every image needs
+    # keys = ['Composite:GPSDateTime', 'Composite:GPSLatitude', 'Composite:GPSLongitude', 'Composite:GPSAltitude']
+    keys = ['Composite:GPSLatitude', 'Composite:GPSLongitude', 'Composite:GPSAltitude']
+
+    if connection_type in ['timegps', 'filename', 'spatial']:
+        keys.append('Composite:GPSDateTime')
+    else:
+        keys.append('EXIF:DateTimeOriginal')
+
+    # Exiftool checks the keys itself and leaves out the images missing one, so their metadata is never sent
+    # (-q keeps the "files failed condition" message out of the warnings of the other images)
+    REQUIRED_TAGS_CONDITION = required_tags_condition(keys)
+    if TRACK_LOGS:
+        # Images without GPS tags are geotagged from the track logs by their capture time
+        REQUIRED_TAGS_CONDITION = '({0}) or defined $EXIF:DateTimeOriginal'.format(REQUIRED_TAGS_CONDITION)
+    read_params = ('-q', '-if', REQUIRED_TAGS_CONDITION)
+
+    # Streaming mode: read, filter, link and write the images window by window
+    if STREAM_WINDOW > 0:
+        print('Streaming images in windows of {0}....\n'.format(STREAM_WINDOW))
+        report_path, read_quarantined, read_warnings, preflight_discarded, quarantined = stream_sequence(
+            OUTPUT_PHOTO_DIRECTORY, list_of_files, keys,
+            (cameras[0], read_params, telemetry, EXIFTOOL_TIMEOUT, float(args.batch_target_latency),
+             float(args.batch_max_output_mb) * 1024 * 1024, int(args.prefetch_window),
+             int(float(args.prefetch_kb) * 1024)),
+            STREAM_WINDOW,
+            (MIN_TIME_INTERVAL if TIME_FILTERING else 0, MIN_DISTANCE_INTERVAL if DISTANCE_FITLERING else 0,
+             MIN_ALTITUDE_INTERVAL if ALTITUDE_FITLERING else 0),
+            (connection_type, MAX_FRAME_RATE, MIN_ALTITUDE_INTERVAL, MIN_DISTANCE_INTERVAL),
+            args.deterministic_ids, OUTPUT_MODE, args.skip_unchanged, telemetry, EXIFTOOL_TIMEOUT)
+        write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'read', read_quarantined)
+        write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'read_warnings', read_warnings)
+        write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'write', quarantined)
+        if preflight_discarded:
+            write_preflight_report(OUTPUT_PHOTO_DIRECTORY, keys, REQUIRED_TAGS_CONDITION,
+                                   len(list_of_files) - len(read_quarantined), preflight_discarded)
+        if report_path is None:
+            print('Less than two images left to process. No possible links. Exiting program.')
+            input('Press any key to quit')
+            quit()
+        input('\nMetadata successfully added to images.\n\nPress any key to quit')
+        quit()
 
-    # Get metadata of each file in list_of_images
+    # Get metadata of each file in list_of_images, the input folders are read at the same time
     print('Fetching metadata from all images....\n')
-    with exiftool.ExifTool() as et:
-        list_of_metadata = [{'IMAGE_NAME': image, 'METADATA': et.get_metadata(image)} for image in list_of_files]
+    list_of_metadata = []
+    read_quarantined = {}
+    read_warnings = {}
+    preflight_discarded = []
+    telemetry.start_stage('read', len(list_of_files))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(INPUT_PHOTO_DIRECTORIES)) as executor:
+        reads = [executor.submit(read_metadata, files_of_camera, camera, read_params, telemetry, EXIFTOOL_TIMEOUT,
+                                 float(args.batch_target_latency), float(args.batch_max_output_mb) * 1024 * 1024,
+                                 int(args.prefetch_window), int(float(args.prefetch_kb) * 1024))
+                 for camera, files_of_camera in files_by_camera.items()]
+        for read in reads:
+            camera_metadata, camera_quarantined, camera_warnings, camera_discarded = read.result()
+            list_of_metadata.extend(camera_metadata)
+            read_quarantined.update(camera_quarantined)
+            read_warnings.update(camera_warnings)
+            preflight_discarded.extend(camera_discarded)
+    telemetry.finish_stage()
+    if read_quarantined:
+        print('{0} images could not be read and are quarantined.'.format(len(read_quarantined)))
+    if read_quarantined or read_warnings:
+        if not os.path.isdir(OUTPUT_PHOTO_DIRECTORY):
+            os.mkdir(OUTPUT_PHOTO_DIRECTORY)
+        write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'read', read_quarantined)
+        write_quarantine_report(OUTPUT_PHOTO_DIRECTORY, 'read_warnings', read_warnings)
+
+    # Pre-flight report of the images without the required metadata
+    if preflight_discarded:
+        if not os.path.isdir(OUTPUT_PHOTO_DIRECTORY):
+            os.mkdir(OUTPUT_PHOTO_DIRECTORY)
+        report_path = write_preflight_report(OUTPUT_PHOTO_DIRECTORY, keys, REQUIRED_TAGS_CONDITION,
+                                             len(list_of_files) - len(read_quarantined), preflight_discarded)
+        if not DISCARD:
+            print('\n\n{0} images were encountered that did not have the required metadata.'.format(
+                len(preflight_discarded)))
+            print('Images and required metadata keys are listed in {0}\n\n'.format(report_path))
+            print('Consider using the "-d" option to discard images missing required metadata keys')
+            input('Press any key to quit')
+            quit()
 
     # Create dataframe from list_of_metadata with image name in column and metadata in other column
     df_images = pd.DataFrame(list_of_metadata)
 
     # Process images or files without metadata based on discard setting.
     print('Checking metadata tags of all images...')
-    len_before_disc = len(df_images)
-    # keys = ['Composite:GPSDateTime', 'Composite:GPSLatitude', 'Composite:GPSLongitude', 'Composite:GPSAltitude']
-    keys = ['Composite:GPSLatitude', 'Composite:GPSLongitude', 'Composite:GPSAltitude']
+    len_before_disc = len(df_images) + len(preflight_discarded)
     values = ['LATITUDE', 'LONGITUDE', 'ALTITUDE', 'GPS_DATETIME']
 
-    if connection_type in ['timegps', 'filename']:
-        keys.append('Composite:GPSDateTime')
-    else:
-        keys.append('EXIF:DateTimeOriginal')
+    if len(df_images) == 0:
+        print('All images were discarded. No images left to process. Exiting program.')
+        input('Press any key to quit')
+        quit()
 
+    # With track logs, missing GPS tags are filled in below instead of stopping the run
     df_images[values] = df_images.apply(
-        lambda x: parse_metadata(x, keys, DISCARD), axis=1, result_type='expand')
+        lambda x: parse_metadata(x, keys, DISCARD or bool(TRACK_LOGS)), axis=1, result_type='expand')
+    df_images['GPS_TRACK_ADDED'] = False
+
+    if TRACK_LOGS:
+        untagged = df_images[values].isna().any(axis=1).values
+        print('Geotagging {0} images from the track logs...'.format(untagged.sum()))
+        capture_times = pd.to_datetime(
+            df_images.loc[untagged, 'METADATA'].apply(lambda metadata: metadata.get('EXIF:DateTimeOriginal')),
+            format='%Y:%m:%d %H:%M:%S', errors='coerce')
+        utc_times = (capture_times - pd.Timestamp(0)).dt.total_seconds() + TRACK_OFFSET
+        latitudes, longitudes, altitudes = interpolate_track(track, utc_times.values, TRACK_MAX_GAP)
+        geotagged = ~np.isnan(latitudes)
+        rows = np.flatnonzero(untagged)[geotagged]
+        # Only the missing values are taken from the track, the GPS tags an image has are kept
+        position_missing = df_images.loc[rows, ['LATITUDE', 'LONGITUDE', 'ALTITUDE']].isna().any(axis=1)
+        for column, track_values in [('LATITUDE', latitudes), ('LONGITUDE', longitudes), ('ALTITUDE', altitudes)]:
+            df_images.loc[rows, column] = df_images.loc[rows, column].fillna(
+                pd.Series(track_values[geotagged], index=rows))
+        # Without GPSDateTime, the capture time on the track clock is used
+        track_datetimes = pd.Series(pd.to_datetime(utc_times.values[geotagged], unit='s').strftime(
+            '%Y:%m:%d %H:%M:%SZ'), index=rows)
+        df_images.loc[rows, 'GPS_DATETIME'] = df_images.loc[rows, 'GPS_DATETIME'].fillna(track_datetimes)
+        position_added = position_missing & df_images.loc[rows, ['LATITUDE', 'LONGITUDE', 'ALTITUDE']].notna().all(axis=1)
+        df_images.loc[rows[position_added.values], 'GPS_TRACK_ADDED'] = True
+        not_covered = np.flatnonzero(untagged & df_images[values].isna().any(axis=1).values)
+        print('{0} images geotagged, {1} images not covered by the track logs.'.format(
+            untagged.sum() - len(not_covered), len(not_covered)))
+
+        if not DISCARD and len(not_covered):
+            print('\n\nAn image was encountered that did not have the required metadata and is not covered by the track logs.')
+            print('Image: {0}\n\n'.format(df_images.loc[not_covered[0], 'IMAGE_NAME']))
+            print('Consider using the "-d" option to discard images missing required metadata keys')
+            input('Press any key to quit')
+            quit()
 
     # remove discarded images.
     df_images.dropna(axis=0, how='any', inplace=True)
@@ -341,38 +2203,32 @@ def make_sequence(args):
         quit()
 
     # Convert datetime from string to datetime format
-    df_images['GPS_DATETIME'] = df_images.apply(
-        lambda x: datetime.datetime.strptime(x['GPS_DATETIME'], '%Y:%m:%d %H:%M:%SZ')
-        if 'Z' in x['GPS_DATETIME']
-        else datetime.datetime.strptime(x['GPS_DATETIME'], '%Y:%m:%d %H:%M:%S'), axis=1)
+    df_images['GPS_DATETIME'] = df_images.apply(lambda x: parse_gps_datetime(x['GPS_DATETIME']), axis=1)
 
     # Sort images
-    df_images.sort_values(CONNECTION_TYPE, axis=0, ascending=True, inplace=True)
+    if connection_type == 'spatial':
+        print('Ordering images by position...')
+        df_images = df_images.iloc[spatial_order(df_images['LATITUDE'].values, df_images['LONGITUDE'].values,
+                                                 int(args.two_opt_window))].reset_index(drop=True)
+    elif CONNECTION_TYPE == 'GPS_DATETIME' and len(files_by_camera) > 1:
+        print('Merging the images of {0} cameras by time...'.format(len(files_by_camera)))
+        df_images = df_images.iloc[merge_camera_streams(df_images)].reset_index(drop=True)
+    else:
+        df_images.sort_values(CONNECTION_TYPE, axis=0, ascending=True, inplace=True)
 
     #########################
     # Work with the resulting image dataframe to filter & find the right sequence
 
-    # Calculate the time difference, distance and altitude difference with the NEXT image
-    print('Calculating differences of time, distance and altitude between images...')
-    for conn_type in ['DELTA_TIME', 'DISTANCE', 'DELTA_ALT']:
-        df_images = calculate_to_next(df_images, conn_type)
-
-    # Filter images, drop rows where needed and
-    # re-calculate the distance and altitude differences if rows are dropped
+    # Filter images in one sweep, keeping the images that meet all spacing thresholds
     print('Filtering images according to input parameters...')
-    len_time = len(df_images)
-    df_images = generic_connection(df_images, 'DELTA_TIME', MIN_TIME_INTERVAL)\
-        if TIME_FILTERING else df_images
-    len_dist = len(df_images)
-    print('{0} images discarded due to time spacing intervals'.format(len_time - len_dist))
-    df_images = calculate_to_next(df_images, 'DISTANCE') if TIME_FILTERING else df_images
-    df_images = generic_connection(df_images, 'DISTANCE', MIN_DISTANCE_INTERVAL) if DISTANCE_FITLERING else df_images
-    len_alt = len(df_images)
-    print('{0} images discarded due to distance spacing intervals'.format(len_dist - len_alt))
-    df_images = calculate_to_next(df_images, 'DELTA_ALT') if DISTANCE_FITLERING else df_images
-    df_images = generic_connection(df_images, 'DELTA_ALT', MIN_ALTITUDE_INTERVAL) if ALTITUDE_FITLERING else df_images
-    len_final = len(df_images)
-    print('{0} images discarded due to altitude spacing intervals\n'.format(len_alt - len_final))
+    len_before_filter = len(df_images)
+    kept = fused_filter(df_images,
+                        MIN_TIME_INTERVAL if TIME_FILTERING else 0,
+                        MIN_DISTANCE_INTERVAL if DISTANCE_FITLERING else 0,
+                        MIN_ALTITUDE_INTERVAL if ALTITUDE_FITLERING else 0)
+    df_images = df_images.iloc[kept].reset_index(drop=True)
+    print('{0} images discarded due to time, distance and altitude spacing intervals\n'.format(
+        len_before_filter - len(df_images)))
 
     print('\nFinal amount of images to process: {0}\n\n'.format(len(df_images)))
     if len(df_images) == 0:
@@ -384,40 +2240,12 @@ def make_sequence(args):
         input('Press any key to quit')
         quit()
 
-    # Finally, calculate all differences again to their NEXT image
-    print('Calculating final differences of time, distance and altitude between qualified images...')
-    for conn_type in ['DELTA_TIME', 'DISTANCE', 'DELTA_ALT']:
-        df_images = calculate_to_next(df_images, conn_type)
-
-    # Calculate Azimuth (heading) and Pitch
-    print('Calculating heading between qualified images....')
-    df_images['AZIMUTH'] = df_images.apply(lambda x: calculate_initial_compass_bearing((x['LATITUDE'], x['LONGITUDE']),
-                                                                                       (x['LATITUDE_NEXT'],
-                                                                                        x['LONGITUDE_NEXT'])), axis=1)
-    df_images.iat[-1, df_images.columns.get_loc('AZIMUTH')] = df_images['AZIMUTH'].iloc[-2]
-    df_images['PITCH'] = (df_images['ALTITUDE_NEXT'] - df_images['ALTITUDE']) / df_images['DISTANCE']
-
-    # Add additional required data for output json.
-    # All related to PREVIOUS image
-    print('Setting related data of connected qualified images...')
-    df_images['DISTANCE_TO_PREV'] = -1 * df_images['DISTANCE'].shift(1, fill_value=0)
-    df_images['DELTA_TIME_TO_PREV'] = -1 * df_images['DELTA_TIME'].shift(1)
-    df_images['DELTA_ALT_TO_PREV'] = -1 * df_images['DELTA_ALT'].shift(1)
-    df_images['PITCH_TO_PREV'] = -1 * df_images['PITCH'].shift(1)
-    df_images['AZIMUTH_TO_PREV'] = (df_images['AZIMUTH'].shift(1) + 180) % 360
-
-    df_images.iat[0, df_images.columns.get_loc('DELTA_ALT_TO_PREV')] = 0
-    df_images.iat[0, df_images.columns.get_loc('DISTANCE_TO_PREV')] = 0
-    df_images.iat[0, df_images.columns.get_loc('DELTA_TIME_TO_PREV')] = 0
-    df_images.iat[0, df_images.columns.get_loc('AZIMUTH_TO_PREV')] = 0
-    df_images.iat[0, df_images.columns.get_loc('PITCH_TO_PREV')] = 0
-
-    # Add names of the NEXT and PREVIOUS image for quicker reference
-    df_images['IMAGE_NAME_NEXT'] = df_images['IMAGE_NAME'].shift(-1)
-    df_images['IMAGE_NAME_PREV'] = df_images['IMAGE_NAME'].shift(1)
+    # Finally, calculate all differences again to their NEXT and PREVIOUS image
+    print('Calculating final differences of time, distance, altitude and heading between qualified images...')
+    df_images = link_images(df_images)
 
     # Assign UUID
-    df_images['UUID'] = df_images.apply(lambda x: str(uuid.uuid1()), axis=1)
+    sequence_uuid = assign_uuids(df_images, args.deterministic_ids)
     df_images['UUID_NEXT'] = df_images['UUID'].shift(-1)
     df_images['UUID_PREV'] = df_images['UUID'].shift(1)
 
@@ -425,82 +2253,17 @@ def make_sequence(args):
     # Main keys will be the image to which the subkeys will be added to
 
     print('\nGenerating JSON object...')
-    sequence_uuid = uuid.uuid1()
 
-    duration_sec = (df_images['GPS_DATETIME'].iloc[-1] - df_images['GPS_DATETIME'].iloc[0]).total_seconds()
-    total_distance = df_images['DISTANCE'].sum() / 1000
     report_json = {
-        "sequence": {
-            "id": str(sequence_uuid),
-            "distance_km": total_distance,
-            "earliest_time": df_images['GPS_DATETIME'].iloc[0].strftime('%Y:%m:%d %H:%M:%SZ'),
-            "latest_time": df_images['GPS_DATETIME'].iloc[-1].strftime('%Y:%m:%d %H:%M:%SZ'),
-            "duration_sec": duration_sec,
-            "average_speed_kmh": total_distance * 3600 / duration_sec if duration_sec != 0 else 0,
-            "uploader_sequence_name": None, # not currently used
-            "uploader_sequence_description": None,# not currently used
-            "uploader_transport_type": None# not currently used
-        },
+        "sequence": sequence_summary(sequence_uuid, df_images['GPS_DATETIME'].iloc[0],
+                                     df_images['GPS_DATETIME'].iloc[-1], df_images['DISTANCE'].sum() / 1000),
         "photo": {}
     }
 
-    def get_origin_value(df_row, available_keys):
-        for key in available_keys:
-            if df_row['METADATA'].get(key):
-                return df_row['METADATA'].get(key)
-        return ""
-
     descriptions = {}
     for index, k in df_images.iterrows():
-        photo_dict = {
-            "id": k['UUID'],
-            "original_GPSDateTime": k['METADATA'].get('Composite:GPSDateTime'),
-            "original_originalDateTime": k['METADATA'].get('EXIF:DateTimeOriginal'),
-            "cli_connection_method": connection_type,
-            "cli_frame_rate_set": MAX_FRAME_RATE,
-            "cli_altitude_min_set": MIN_ALTITUDE_INTERVAL,
-            "cli_distance_min_set": MIN_DISTANCE_INTERVAL,
-            "original_filename": k['IMAGE_NAME'],
-            "original_altitude": k['METADATA'].get('Composite:GPSAltitude'),
-            "original_latitude": k['METADATA'].get('Composite:GPSLatitude'),
-            "original_longitude": k['METADATA'].get('Composite:GPSLongitude'),
-            "orignal_gps_direction_ref": k['METADATA'].get('EXIF:GPSImgDirectionRef', ""),
-            "orignal_gps_speed": k['METADATA'].get('EXIF:GPSSpeed', ""),
-            "original_heading": get_origin_value(k, ["XMP:PoseHeadingDegrees", "EXIF:GPSImgDirection"]),
-            "original_pitch": get_origin_value(k, ["XMP:PosePitchDegrees", "EXIF:GPSPitch"]),
-            "original_roll": get_origin_value(k, ["XMP:PosePoseRollDegrees", "EXIF:GPSRoll"]),
-            "original_camera_make": k['METADATA'].get('EXIF:Make'),
-            "original_camera_model": k['METADATA'].get('EXIF:Model'),
-            "original_projection": k['METADATA'].get('XMP:ProjectionType'),
-            "software_version": 1.0,  # shows version of sequence maker used from version txt,
-            "uploader_photo_from_video": None,  # not currently used,
-            "uploader_nadir_added": None,  # not currently used,
-            "uploader_blur_added": None,  # not currently used,
-            "uploader_gps_track_added": None,  # not currently used,
-            "uploader_gps_modified": None,  # not currently used,
-            "uploader_tags": None, # not currently used
-            'connections': {
-                k['UUID_NEXT']: {
-                    'distance_mtrs': k['DISTANCE'],
-                    'elevation_mtrs': k['DELTA_ALT'],
-                    'heading_deg': k['AZIMUTH'],
-                    'pitch_deg': k['PITCH'],
-                    'time_sec': k['DELTA_TIME'],
-                    'speed_kmh': (k['DISTANCE'] * 3600) / (k['DELTA_TIME'] * 1000) if k[
-                                                                                          'DELTA_TIME'] != 0 else 0
-                },
-
-                k['UUID_PREV']: {
-                    'distance_mtrs': k['DISTANCE_TO_PREV'],
-                    'elevation_mtrs': k['DELTA_ALT_TO_PREV'],
-                    'heading_deg': k['AZIMUTH_TO_PREV'],
-                    'adj_heading_deg': abs(k['AZIMUTH'] - k['AZIMUTH_TO_PREV']),
-                    'pitch_deg': k['PITCH_TO_PREV'],
-                    'time_sec': k['DELTA_TIME_TO_PREV'],
-                    'speed_kmh': (k['DISTANCE_TO_PREV'] * 3600) / (k['DELTA_TIME_TO_PREV'] * 1000) if k['DELTA_TIME_TO_PREV'] != 0 else 0
-                }
-            }
-        }
+        photo_dict = photo_description(k, connection_type, MAX_FRAME_RATE, MIN_ALTITUDE_INTERVAL,
+                                       MIN_DISTANCE_INTERVAL)
         descriptions.update({
             k['UUID']: {
                 "photo": photo_dict,
@@ -513,29 +2276,22 @@ def make_sequence(args):
 
     img_id_link = {k['UUID']: k['IMAGE_NAME'] for index, k in df_images.iterrows()}
 
-    # Remove the 'nan' links of the first image to its PREVIOUS, and
-    # the NEXT image of the last image
-    to_del = []
-    for image in descriptions.keys():
-        for connection in descriptions[image]['photo']['connections'].keys():
-            if type(connection) == float:
-                to_del.append([image, connection])
-
-    for z, y in to_del:
-        del descriptions[z]['photo']['connections'][y]
+    existing_descriptions = {k['UUID']: k['METADATA'].get('EXIF:ImageDescription') for index, k in df_images.iterrows()}
 
-        # For each image, write the JSON into EXIF::ImageDescription
-    print('Writing metadata to EXIF::ImageDescription of qualified images...\n')
-    with exiftool.ExifTool() as et:
-        for image_uuid in descriptions.keys():
-            et.execute(bytes('-ImageDescription={0}'.format(json.dumps(descriptions[image_uuid])), 'utf-8'),
-                       bytes("{0}".format(img_id_link[image_uuid]), 'utf-8'))
+    # Shard mode: stop here, the descriptions are completed when the shards are merged
+    if args.shard_manifest:
+        write_shard_manifest(args.shard_manifest, report_json, df_images, descriptions, img_id_link,
+                             existing_descriptions)
+        input('\nShard manifest successfully saved.\n\nPress any key to quit')
+        quit()
 
-    clean_up_new_files(OUTPUT_PHOTO_DIRECTORY, [image for image in img_id_link.values()])
+    save_sequence(OUTPUT_PHOTO_DIRECTORY, JOURNAL_PATH, sequence_uuid, report_json, descriptions, img_id_link,
+                  existing_descriptions, OUTPUT_MODE, PAYLOAD_FORMAT, args.skip_unchanged, telemetry, EXIFTOOL_TIMEOUT)
 
-    print('Writing report json')
-    with open("{}.json".format(sequence_uuid), "w") as outfile:
-        json.dump(report_json, outfile)
+    if TABLE_FORMATS:
+        write_table(sequence_uuid, df_images, TABLE_FORMATS)
+    if args.graph_index:
+        write_graph_index(sequence_uuid, df_images)
 
     input('\nMetadata successfully added to images.\n\nPress any key to quit')
     quit()
@@ -566,7 +2322,13 @@ if __name__ == '__main__':
                         action='store',
                         default='timegps',
                         dest='connection_type',
-                        help='Join images in a sequence with connection type (timegps, timecapture, filename)')
+                        help='Join images in a sequence with connection type (timegps, timecapture, filename, spatial)')
+
+    parser.add_argument('--two-opt-window',
+                        action='store',
+                        default='0',
+                        dest='two_opt_window',
+                        help='Optional: for the spatial connection type, refine the path with 2-opt moves between images up to this many positions apart.')
 
     parser.add_argument('-d', '--discard',
                         action='store_true',
@@ -574,15 +2336,135 @@ if __name__ == '__main__':
                         dest='discard',
                         help='Force the program to continue if images do not have all required metadata. Such images will be discarded.')
 
+    parser.add_argument('-g', '--track-log',
+                        action='append',
+                        dest='track_log',
+                        help='Optional: GPX or CSV track log to geotag images without GPS tags from. Can be given several times.')
+
+    parser.add_argument('--track-offset',
+                        action='store',
+                        default='0',
+                        dest='track_offset',
+                        help='Seconds added to the capture time (DateTimeOriginal) of an image to get the UTC time of the track logs.')
+
+    parser.add_argument('--track-max-gap',
+                        action='store',
+                        default='60',
+                        dest='track_max_gap',
+                        help='Maximum seconds between the two track points around an image to interpolate its position.')
+
     parser.add_argument('-e', '--exiftool-exec-path',
                         action='store',
                         default='No path specified',
                         dest='executable_path',
                         help='Optional: path to Exiftool executionable.')
 
+    parser.add_argument('--exiftool-timeout',
+                        action='store',
+                        default='0',
+                        dest='exiftool_timeout',
+                        help='Optional: seconds an Exiftool command may take. Enables supervision: a hung or dead Exiftool is restarted, the command retried once, and images that keep failing are quarantined.')
+
+    parser.add_argument('-r', '--resume',
+                        action='store_true',
+                        default=False,
+                        dest='resume',
+                        help='Finish the writes and renames of an interrupted run from the journal in the output folder.')
+
+    parser.add_argument('-i', '--deterministic-ids',
+                        action='store_true',
+                        default=False,
+                        dest='deterministic_ids',
+                        help='Derive photo and sequence UUIDs from the images, so reruns on the same images give the same IDs.')
+
+    parser.add_argument('-u', '--skip-unchanged',
+                        action='store_true',
+                        default=False,
+                        dest='skip_unchanged',
+                        help='Do not write or move images whose ImageDescription already holds the calculated description.')
+
+    parser.add_argument('-o', '--output-mode',
+                        action='store',
+                        default='images',
+                        dest='output_mode',
+                        help='Write the descriptions into copies of the images (images), into XMP sidecars (xmp) or into one manifest json (manifest)')
+
+    parser.add_argument('--payload-format',
+                        action='store',
+                        default='full',
+                        dest='payload_format',
+                        help='Format of the written JSON object: full, or compact (short keys, no nulls, sequence block by reference)')
+
+    parser.add_argument('-t', '--export-table',
+                        action='store',
+                        default='',
+                        dest='export_table',
+                        help='Optional: also export the computed sequence table as parquet, arrow and/or feather (comma separated). Requires pyarrow.')
+
+    parser.add_argument('--shard-manifest',
+                        action='store',
+                        default=None,
+                        dest='shard_manifest',
+                        help='Optional: process the input folder as one time-ordered slice (shard) of a sequence and save a partial manifest to this path instead of writing any output.')
+
+    parser.add_argument('-x', '--graph-index',
+                        action='store_true',
+                        default=False,
+                        dest='graph_index',
+                        help='Optional: also write a binary index of the photos and their NEXT/PREVIOUS photos next to the report json.')
+
+    parser.add_argument('-m', '--merge-shards',
+                        action='store_true',
+                        default=False,
+                        dest='merge_shards',
+                        help='Merge the shard manifests found in the input folder into one sequence, and write it to the output folder.')
+
+    parser.add_argument('-w', '--stream-window',
+                        action='store',
+                        default='0',
+                        dest='stream_window',
+                        help='Optional: process images already in sequence order by filename in windows of this many images, which keeps memory use flat. 0 disables it.')
+
+    parser.add_argument('-p', '--progress-interval',
+                        action='store',
+                        default='5',
+                        dest='progress_interval',
+                        help='Seconds between progress lines of the metadata read and write stages. 0 disables them.')
+
+    parser.add_argument('--prometheus-textfile',
+                        action='store',
+                        default=None,
+                        dest='prometheus_textfile',
+                        help='Optional: path of a .prom file to keep updated with throughput metrics for the node_exporter textfile collector.')
+
+    parser.add_argument('--batch-target-latency',
+                        action='store',
+                        default='1',
+                        dest='batch_target_latency',
+                        help='Seconds each Exiftool read command should take. The number of images per command is adapted to it.')
+
+    parser.add_argument('--batch-max-output-mb',
+                        action='store',
+                        default='64',
+                        dest='batch_max_output_mb',
+                        help='Maximum size in MB of the metadata returned by one Exiftool read command.')
+
+    parser.add_argument('--prefetch-window',
+                        action='store',
+                        default='16',
+                        dest='prefetch_window',
+                        help='Number of images ahead of the metadata read whose headers are fetched in the background. 0 disables it.')
+
+    parser.add_argument('--prefetch-kb',
+                        action='store',
+                        default='128',
+                        dest='prefetch_kb',
+                        help='Size in KB of the header region fetched ahead for each image.')
+
     parser.add_argument('input_directory',
                         action="store",
-                        help='Path to input folder.')
+                        nargs='+',
+                        help='Path to input folder. Several folders (e.g. one per camera of a rig) are merged into one sequence.')
     parser.add_argument('output_directory',
                         action="store",
                         help='Path to output folder.')
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Author: hq@trekview.org
+# Created: 2020-06-04
+# Copyright: Trek View
+# Licence: GNU AGPLv3
+# -------------------------------------------------------------------------------
+
+'''
+Binary index of the photos of a sequence, written next to the report json as [SEQUENCE_ID].idx.
+
+It lets viewers walk a sequence without parsing the report json or the ImageDescription of every image.
+The file is little-endian:
+ * a header: magic "SQIX", version, record size, number of photos and the sequence id (16 bytes),
+ * one fixed-width record per photo, sorted by photo id: photo id (16 bytes), position in the sequence,
+   time (milliseconds since 1970-01-01) and the record numbers of the NEXT and PREVIOUS photo (-1 if none),
+ * the record numbers of all photos in time order.
+SequenceIndex memory-maps the file and finds a photo by id or by time with a binary search,
+and its neighbours by their record number, without reading the rest of the file.
+'''
+
+import collections
+import datetime
+import mmap
+import struct
+import uuid
+
+INDEX_MAGIC = b'SQIX'
+INDEX_VERSION = 1
+
+HEADER = struct.Struct('<4sHHI16s')
+RECORD = struct.Struct('<16sIqii')
+RECORD_NUMBER = struct.Struct('<I')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+Photo = collections.namedtuple('Photo', ['id', 'position', 'time', 'next', 'previous'])
+
+
+def write_index(path, sequence_id, photo_ids, times):
+    '''
+    Write the index of a sequence. `photo_ids` are the photo UUIDs in sequence order,
+    `times` their (UTC) datetimes.
+    '''
+    photo_bytes = [uuid.UUID(str(photo_id)).bytes for photo_id in photo_ids]
+    milliseconds = [int(round((time - EPOCH).total_seconds() * 1000)) for time in times]
+
+    # Record number of every position, records are sorted by photo id
+    by_id = sorted(range(len(photo_bytes)), key=lambda position: photo_bytes[position])
+    record_numbers = [0] * len(photo_bytes)
+    for record_number, position in enumerate(by_id):
+        record_numbers[position] = record_number
+
+    with open(path, 'wb') as outfile:
+        outfile.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, RECORD.size, len(photo_bytes),
+                                  uuid.UUID(str(sequence_id)).bytes))
+        for position in by_id:
+            outfile.write(RECORD.pack(photo_bytes[position], position, milliseconds[position],
+                                      record_numbers[position + 1] if position + 1 < len(photo_bytes) else -1,
+                                      record_numbers[position - 1] if position > 0 else -1))
+        for position in sorted(range(len(photo_bytes)), key=lambda position: milliseconds[position]):
+            outfile.write(RECORD_NUMBER.pack(record_numbers[position]))
+
+
+class SequenceIndex(object):
+    '''
+    Read-only view of an index written by write_index().
+
+        with SequenceIndex('SEQUENCE_ID.idx') as index:
+            photo = index.get(photo_id)
+            following = index.next(photo_id)
+            closest = index.nearest_time(datetime.datetime(2020, 6, 4, 10, 0, 5))
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError('{0} is not a sequence index'.format(path))
+        magic, version, record_size, self.count, sequence_bytes = HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError('{0} is not a sequence index'.format(path))
+        if version != INDEX_VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError('Unknown sequence index version {0}'.format(version))
+        self.sequence_id = str(uuid.UUID(bytes=sequence_bytes))
+        self.time_table = HEADER.size + self.count * RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _record(self, record_number):
+        return RECORD.unpack_from(self.map, HEADER.size + record_number * RECORD.size)
+
+    def _photo_id(self, record_number):
+        offset = HEADER.size + record_number * RECORD.size
+        return self.map[offset:offset + 16]
+
+    def _photo(self, record_number):
+        if record_number < 0:
+            return None
+        photo_bytes, position, milliseconds, next_record, previous_record = self._record(record_number)
+        return Photo(
+            id=str(uuid.UUID(bytes=photo_bytes)),
+            position=position,
+            time=EPOCH + datetime.timedelta(milliseconds=milliseconds),
+            next=str(uuid.UUID(bytes=self._photo_id(next_record))) if next_record >= 0 else None,
+            previous=str(uuid.UUID(bytes=self._photo_id(previous_record))) if previous_record >= 0 else None,
+        )
+
+    def _find(self, photo_id):
+        photo_bytes = uuid.UUID(str(photo_id)).bytes
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._photo_id(middle) < photo_bytes:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count or self._photo_id(low) != photo_bytes:
+            raise KeyError(photo_id)
+        return low
+
+    def _time_at(self, rank):
+        record_number = RECORD_NUMBER.unpack_from(self.map, self.time_table + rank * RECORD_NUMBER.size)[0]
+        return record_number, self._record(record_number)[2]
+
+    def __contains__(self, photo_id):
+        try:
+            self._find(photo_id)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, photo_id):
+        '''
+        Return the photo with this id. Raise KeyError if it is not in the sequence.
+        '''
+        return self._photo(self._find(photo_id))
+
+    def next(self, photo_id):
+        '''
+        Return the NEXT photo of the photo with this id, None for the last photo.
+        '''
+        return self._photo(self._record(self._find(photo_id))[3])
+
+    def previous(self, photo_id):
+        '''
+        Return the PREVIOUS photo of the photo with this id, None for the first photo.
+        '''
+        return self._photo(self._record(self._find(photo_id))[4])
+
+    def nearest_time(self, time):
+        '''
+        Return the photo taken closest to `time` (a UTC datetime), the earlier one if two are as close.
+        '''
+        if self.count == 0:
+            return None
+        milliseconds = int(round((time - EPOCH).total_seconds() * 1000))
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._time_at(middle)[1] < milliseconds:
+                low = middle + 1
+            else:
+                high = middle
+        candidates = [self._time_at(rank) for rank in [low - 1, low] if 0 <= rank < self.count]
+        record_number, _ = min(candidates, key=lambda candidate: abs(candidate[1] - milliseconds))
+        return self._photo(record_number)
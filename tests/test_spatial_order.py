@@ -0,0 +1,60 @@
+'''
+Regression checks of spatial_order() on input that made its grid search quadratic:
+an outlier far from the route, images at the same position and images on a straight line.
+'''
+
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+spec = importlib.util.spec_from_file_location('sequence_maker', os.path.join(ROOT, 'sequence-maker.py'))
+sequence_maker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sequence_maker)
+
+# Seconds allowed per case, far above the linear time and far below the quadratic one
+TIME_LIMIT = 10
+
+
+def random_walk(n):
+    steps = np.random.default_rng(0).normal(0, 3e-5, (n, 2))
+    positions = np.cumsum(steps, axis=0)
+    return 51 + positions[:, 0], -1 + positions[:, 1]
+
+
+def check_order(latitudes, longitudes):
+    started = time.monotonic()
+    order = sequence_maker.spatial_order(latitudes, longitudes)
+    assert time.monotonic() - started < TIME_LIMIT
+    assert sorted(order.tolist()) == list(range(len(latitudes)))
+    return order
+
+
+def test_outlier():
+    latitudes, longitudes = random_walk(20000)
+    # A GPS glitch about 400 km away
+    latitudes[7000] += 3.6
+    order = check_order(latitudes, longitudes)
+    assert order[0] == 7000 or order[-1] == 7000
+
+
+def test_same_position():
+    check_order(np.full(8000, 51.0), np.full(8000, -1.0))
+
+
+def test_straight_line():
+    steps = np.arange(50000)
+    order = check_order(51 + steps * 2e-5, np.full(50000, -1.0))
+    assert (np.abs(np.diff(order)) == 1).all()
+
+
+def test_route_order():
+    steps = np.arange(1000)
+    latitudes, longitudes = 51 + steps * 3e-5, -1 + steps * 2e-5
+    shuffled = np.random.default_rng(1).permutation(1000)
+    order = check_order(latitudes[shuffled], longitudes[shuffled])
+    assert (np.abs(np.diff(shuffled[order])) == 1).all()